@@ -0,0 +1,39 @@
+import argparse
+import os
+import synthetic
+
+# Days of history per city when the number of cities isn't given, about the same as the Kaggle source
+DAYS_PER_CITY = 9125
+
+def main():
+    '''
+    Generate synthetic source files shaped like the parts of city_temperature.csv
+    '''
+    parser = argparse.ArgumentParser(description="Generate synthetic city_temperature CSV parts")
+    parser.add_argument("--rows", type=int, default=1000000, help="total number of daily rows")
+    parser.add_argument("--parts", type=int, default=2, help="number of CSV parts")
+    parser.add_argument("--cities", type=int, help="number of distinct cities (default: about 25 years of history per city)")
+    parser.add_argument("--missing", type=float, default=0.02, help="share of -99 missing temperatures")
+    parser.add_argument("--chunk-rows", type=int, default=1000000, help="rows generated and written at a time")
+    parser.add_argument("--seed", type=int, default=42, help="random seed")
+    parser.add_argument("--output-dir", default="benchmark-data", help="directory of the generated parts")
+    args = parser.parse_args()
+
+    cities = args.cities or max(args.rows // DAYS_PER_CITY, 1)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    # Split the rows evenly over the parts and write each part in chunks
+    rowsPerPart = -(-args.rows // args.parts)
+    for part in range(args.parts):
+        path = os.path.join(args.output_dir, f"city_temperature-{part + 1}.csv")
+        first = part * rowsPerPart
+        last = min(first + rowsPerPart, args.rows)
+
+        for start in range(first, last, args.chunk_rows):
+            data = synthetic.sourceFrame(min(args.chunk_rows, last - start), cities, args.missing, args.seed, start)
+            data.to_csv(path, mode="w" if start == first else "a", header=start == first, index=False)
+
+        print(f"{path}: {last - first} rows")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import argparse
+import os
+import sys
+import time
+
+# Make the ETL and shared library modules importable
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'etl'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+import psycopg2
+import dbconfig
+import etl_process
+import synthetic
+
+def main():
+    '''
+    Compare the bulk load modes of the ETL process against a scratch table
+    '''
+    parser = argparse.ArgumentParser(description="Benchmark the ETL load modes")
+    parser.add_argument("--rows", type=int, default=300000, help="number of transformed rows to load")
+    parser.add_argument("--chunk-size", type=int, default=etl_process.LOAD_CHUNK_SIZE, help="rows per transaction")
+    parser.add_argument("--modes", default="copy,values", help="comma separated list of load modes")
+    parser.add_argument("--host", default=dbconfig.HOST, help="database host")
+    args = parser.parse_args()
+
+    # Number the cities like the city table would, keeping the columns written to the temperatures table
+    data = synthetic.transformedFrame(args.rows)
+    data = data.assign(CityId=(data.City.factorize()[0] + 1).astype("int32"))[etl_process.FRAME_COLUMNS]
+
+    # Open connection to the database and create a scratch table shaped like temperatures
+    connection = psycopg2.connect(f"host='{args.host}' dbname='{dbconfig.DBNAME}' user='{dbconfig.USER}' password='{dbconfig.PASSWORD}'")
+    cursor = connection.cursor()
+    cursor.execute("create table IF NOT EXISTS temperatures_benchmark (city_id int, date date, quarter smallint, avgtemp real );")
+    connection.commit()
+
+    for mode in args.modes.split(","):
+        cursor.execute("truncate temperatures_benchmark;")
+        connection.commit()
+
+        # Load the frame chunk by chunk, one transaction per chunk
+        start = time.perf_counter()
+        for offset in range(0, len(data), args.chunk_size):
+            etl_process.loadChunk(cursor, data.iloc[offset:offset + args.chunk_size], mode, "temperatures_benchmark")
+            connection.commit()
+        elapsed = time.perf_counter() - start
+
+        print(f"{mode:>8}: {len(data)} rows in {elapsed:.2f}s ({len(data) / elapsed:,.0f} rows/s)")
+
+    # Remove the scratch table
+    cursor.execute("drop table temperatures_benchmark;")
+    connection.commit()
+    connection.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+import argparse
+import importlib.util
+import os
+import sys
+import time
+
+# Make the ML process and shared library modules importable
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+spec = importlib.util.spec_from_file_location("ml_process", os.path.join(os.path.dirname(__file__), '..', 'ml', 'ml-process.py'))
+ml_process = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(ml_process)
+
+import synthetic
+
+def main():
+    '''
+    Time the ML cluster to temperature level mapping for increasing numbers of cities
+    '''
+    parser = argparse.ArgumentParser(description="Benchmark the ML transformation")
+    parser.add_argument("--cities", default="1000,10000,100000", help="comma separated list of city counts")
+    parser.add_argument("--repeat", type=int, default=5, help="number of timed runs per city count")
+    args = parser.parse_args()
+
+    for cities in [int(count) for count in args.cities.split(",")]:
+        data = synthetic.clusteredFrame(cities, ml_process.N_CLUSTERS)
+
+        # Time each run on a fresh copy, as the task adds a column to its input
+        # The task function is called without its metrics wrapper, which would need a database
+        timings = []
+        for _ in range(args.repeat):
+            source = data.copy()
+            start = time.perf_counter()
+            ml_process.transform.run.__wrapped__(source)
+            timings.append(time.perf_counter() - start)
+
+        best = min(timings)
+        print(f"{cities:>8} cities ({len(data)} rows): best {best:.4f}s ({len(data) / best:,.0f} rows/s)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import argparse
+import importlib.util
+import subprocess
+import threading
+import resource
+import tempfile
+import json
+import glob
+import time
+import sys
+import os
+
+# Make the ETL and shared library modules importable
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'etl'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+import psycopg2
+import dbconfig
+
+class PeakMemory:
+    '''
+    Sample the resident memory of the process in the background and keep its peak
+    '''
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self.running = False
+
+    def current(self):
+        # Resident pages from /proc on Linux, peak of the whole process elsewhere
+        try:
+            with open("/proc/self/statm") as statm:
+                return int(statm.read().split()[1]) * resource.getpagesize()
+        except OSError:
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def sample(self):
+        while self.running:
+            self.peak = max(self.peak, self.current())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.running = True
+        self.peak = self.current()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.running = False
+        self.thread.join()
+        self.peak = max(self.peak, self.current())
+
+def loadModule(name, path):
+    '''
+    Import a job module from its file, as some file names are not valid module names
+    '''
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def prepareDatabase(host, dbname):
+    '''
+    Create the benchmark database if needed and remove the tables of previous runs
+    '''
+    connection = psycopg2.connect(f"host='{host}' dbname='{dbconfig.DBNAME}' user='{dbconfig.USER}' password='{dbconfig.PASSWORD}'")
+    connection.autocommit = True
+    cursor = connection.cursor()
+    cursor.execute("select 1 from pg_database where datname = %s;", (dbname,))
+    if cursor.fetchone() is None:
+        cursor.execute(f"create database {dbname};")
+    connection.close()
+
+    connection = psycopg2.connect(f"host='{host}' dbname='{dbname}' user='{dbconfig.USER}' password='{dbconfig.PASSWORD}'")
+    connection.autocommit = True
+    connection.cursor().execute("drop table IF EXISTS temperatures, city, temperature_quarter, temperature_city_year, temperature_country_month, temperature_region_month, temperature_level, status, current_state, status_run, task_metrics cascade;")
+    connection.close()
+
+def main():
+    '''
+    Run every pipeline stage on synthetic source files against a local database and report its throughput
+    '''
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline end to end")
+    parser.add_argument("--data-dir", default="benchmark-data", help="directory of the CSV parts created by generate_data.py")
+    parser.add_argument("--host", default="localhost", help="database host")
+    parser.add_argument("--dbname", default="benchmark", help="database created and used for the benchmark")
+    parser.add_argument("--output", help="JSON file with the results (default: benchmark-<commit>.json)")
+    args = parser.parse_args()
+
+    # Point the jobs to the benchmark database and to scratch directories before importing them
+    dbconfig.HOST = args.host
+    dbconfig.DBNAME = args.dbname
+    workDir = tempfile.mkdtemp(prefix="benchmark-")
+    os.makedirs(os.path.join(workDir, "pages"))
+    os.environ["ML_MODEL_DIR"] = os.path.join(workDir, "model")
+    os.environ["ETL_CACHE"] = "false"
+
+    prepareDatabase(args.host, args.dbname)
+
+    code = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    sys.path.insert(0, os.path.join(code, 'visualization'))
+    import dbpool
+    import etl_process
+    ml = loadModule("ml_process", os.path.join(code, 'ml', 'ml-process.py'))
+    visualization = loadModule("visualization_process", os.path.join(code, 'visualization', 'visualization-process.py'))
+
+    # Read the generated parts and write the pages to the scratch directory
+    startDir = os.getcwd()
+    etl_process.SOURCE_FILES = sorted(glob.glob(os.path.join(os.path.abspath(args.data_dir), "city_temperature-*.csv")))
+    os.chdir(workDir)
+    etl_process.createTable()
+
+    stages = []
+    def measureStage(name, function, *arguments, rows=None):
+        '''
+        Run one stage and record its duration, throughput, peak memory and database time
+        '''
+        roundTrips = dbpool.getRoundTrips()
+        dbSeconds = dbpool.getDatabaseSeconds()
+        with PeakMemory() as memory:
+            start = time.perf_counter()
+            result = function(*arguments)
+            seconds = time.perf_counter() - start
+
+        rows = rows(result) if rows else len(result)
+        stages.append({
+            "stage": name,
+            "seconds": round(seconds, 3),
+            "rows": rows,
+            "rowsPerSecond": round(rows / seconds) if seconds else None,
+            "peakRssMb": round(memory.peak / 2**20, 1),
+            "dbSeconds": round(dbpool.getDatabaseSeconds() - dbSeconds, 3),
+            "dbRoundTrips": dbpool.getRoundTrips() - roundTrips,
+        })
+        print(f"{name:>24}: {seconds:8.2f}s {rows:>12} rows {stages[-1]['peakRssMb']:>8} MB peak {stages[-1]['dbSeconds']:>8}s in db")
+        return result
+
+    # ETL stages, run as a single partition
+    lastLoaded = etl_process.getLoadStart()
+    source = measureStage("etl.extract", etl_process.extract.run, lastLoaded)
+    data = measureStage("etl.transform", etl_process.transformData, source, rows=lambda _: len(source))
+    lastLoaded = etl_process.prepareLoad.run([data], lastLoaded)
+    loaded = measureStage("etl.load", etl_process.load.run, data, lastLoaded, rows=lambda result: result[0])
+    measureStage("etl.completeLoad", etl_process.completeLoad.run, [loaded], lastLoaded, rows=lambda _: loaded[0])
+    del source
+
+    # ML stages
+    ml.createTable.run()
+    data = measureStage("ml.extract", ml.extract.run)
+    data = measureStage("ml.createModel", ml.createModel.run, data)
+    data = measureStage("ml.transform", ml.transform.run, data)
+    measureStage("ml.load", ml.load.run, data, rows=lambda _: len(data))
+
+    # Visualization renders, each page regenerated once
+    visualization.createTable()
+    fingerprints = visualization.getFingerprints.run()
+    measureStage("visualization.status", visualization.getStatus.run, fingerprints, rows=lambda _: 0)
+    measureStage("visualization.etl", visualization.getETLResult.run, fingerprints, rows=lambda _: 0)
+    measureStage("visualization.trends", visualization.getTrends.run, fingerprints, rows=lambda _: 0)
+    measureStage("visualization.ml", visualization.getMLResult.run, fingerprints, rows=lambda _: len(data))
+
+    # Save machine readable results, named after the commit they were measured on
+    commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=code, capture_output=True, text=True).stdout.strip() or "unknown"
+    results = {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "sourceFiles": [os.path.basename(path) for path in etl_process.SOURCE_FILES],
+        "stages": stages,
+    }
+    output = os.path.join(startDir, args.output or f"benchmark-{commit}.json")
+    with open(output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"Results saved to {output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import numpy
+import pandas
+
+def transformedFrame(rows, cities=500, seed=42):
+    '''
+    Generate a data frame shaped like the output of the ETL transform task
+        - one row per city and month, starting in January 1995
+        - columns Region, Country, City, AvgTemperature, Quarter and Date
+    '''
+    random = numpy.random.default_rng(seed)
+
+    # Spread the requested rows over the cities, one month per row
+    city = pandas.Series(numpy.arange(rows) % cities)
+    months = pandas.Series(numpy.arange(rows) // cities)
+    year = 1995 + months // 12
+    month = months % 12 + 1
+
+    data = pandas.DataFrame({
+        "Region": "Region " + (city % 7).astype(str),
+        "Country": "Country " + (city % 120).astype(str),
+        "City": "City " + city.astype(str),
+        "AvgTemperature": random.uniform(-30, 40, rows).round(2),
+        "Quarter": (month - 1) // 3 + 1,
+        "Date": pandas.to_datetime(pandas.DataFrame({"year": year, "month": month, "day": 1})),
+    })
+
+    return data
+
+def sourceFrame(rows, cities=500, missing=0.02, seed=42, start=0):
+    '''
+    Generate a data frame shaped like the extracted city_temperature.csv source
+        - one row per city and day, starting on 1 January 1995
+        - a share of the temperatures is set to the -99 missing data sentinel
+        - start is the number of rows generated before, so large sources can be generated in chunks
+    '''
+    random = numpy.random.default_rng(seed + start)
+
+    # Spread the requested rows over the cities, one day per row
+    ids = numpy.arange(start, start + rows)
+    city = pandas.Series(ids % cities)
+    date = pandas.Timestamp("1995-01-01") + pandas.to_timedelta(ids // cities, unit="D")
+
+    temperature = random.uniform(-20, 100, rows).round(1)
+    temperature[random.random(rows) < missing] = -99
+
+    data = pandas.DataFrame({
+        "Region": ("Region " + (city % 7).astype(str)).astype("string"),
+        "Country": ("Country " + (city % 120).astype(str)).astype("string"),
+        "State": pandas.Series([""] * rows, dtype="string"),
+        "City": ("City " + city.astype(str)).astype("string"),
+        "Month": date.month,
+        "Day": date.day,
+        "Year": date.year,
+        "AvgTemperature": temperature,
+    })
+
+    return data
+
+def clusteredFrame(cities, clusters=5, seed=42):
+    '''
+    Generate a data frame shaped like the output of the ML createModel task
+        - one row per city id and quarter with a random cluster number
+    '''
+    random = numpy.random.default_rng(seed)
+    rows = cities * 4
+
+    city = pandas.Series(numpy.arange(rows) // 4)
+
+    data = pandas.DataFrame({
+        "city_id": (city + 1).astype("int32"),
+        "quarter": numpy.arange(rows) % 4 + 1,
+        "avgtemp": random.uniform(-30, 40, rows).round(2),
+        "cluster": random.integers(0, clusters, rows, dtype="int32"),
+    })
+
+    return data
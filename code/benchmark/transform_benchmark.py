@@ -0,0 +1,43 @@
+import argparse
+import os
+import sys
+import time
+
+# Make the ETL and shared library modules importable
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'etl'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+import etl_process
+import synthetic
+
+def main():
+    '''
+    Time the ETL transformation on a synthetic source data frame
+    '''
+    parser = argparse.ArgumentParser(description="Benchmark the ETL transformation")
+    parser.add_argument("--rows", type=int, default=1000000, help="number of daily source rows")
+    parser.add_argument("--cities", type=int, default=500, help="number of distinct cities")
+    parser.add_argument("--repeat", type=int, default=5, help="number of timed runs")
+    parser.add_argument("--max-seconds", type=float, help="fail if the best run is slower than this")
+    args = parser.parse_args()
+
+    data = synthetic.sourceFrame(args.rows, args.cities)
+
+    # Time each run on a fresh copy of the source frame
+    timings = []
+    for _ in range(args.repeat):
+        source = data.copy()
+        start = time.perf_counter()
+        result = etl_process.transformData(source)
+        timings.append(time.perf_counter() - start)
+
+    best = min(timings)
+    print(f"transform: {args.rows} rows -> {len(result)} rows, best {best:.3f}s, mean {sum(timings) / len(timings):.3f}s ({args.rows / best:,.0f} rows/s)")
+
+    # Flag a regression when a time budget is given
+    if args.max_seconds is not None and best > args.max_seconds:
+        print(f"transform is slower than the {args.max_seconds}s budget")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,96 +1,595 @@
 from datetime import timedelta, datetime
 from dateutil.relativedelta import relativedelta
-from prefect import task, Flow
+from prefect import task, Flow, unmapped
 from prefect.schedules import IntervalSchedule
 from prefect.executors import LocalDaskExecutor
-import psycopg2
+from prefect.triggers import all_finished
+from prefect.engine import signals
+import psycopg2.extras
 import pandas
-import dbconfig
+import pyarrow
+import pyarrow.feather
+import pyarrow.compute
+import dbpool
+import dbmetrics
 import dbstatus
+import hashlib
+import json
+import io
 import os
 
+# Transformation mode
+# - TRANSFORM_MODE: 'pandas' transforms the source in the ETL process, 'database' copies the raw daily rows to PostgreSQL and transforms them there
+TRANSFORM_MODE = os.environ.get('TRANSFORM_MODE', 'pandas')
+
+# Load settings
+# - LOAD_MODE: 'copy' streams rows through COPY FROM STDIN, 'values' uses batched INSERT statements
+# - LOAD_CHUNK_SIZE: number of rows written per transaction
+LOAD_MODE = os.environ.get('LOAD_MODE', 'copy')
+LOAD_CHUNK_SIZE = int(os.environ.get('LOAD_CHUNK_SIZE', 50000))
+
+# Number of partitions transformed and loaded in parallel
+ETL_PARTITIONS = int(os.environ.get('ETL_PARTITIONS', os.cpu_count() or 1))
+
+# Number of years stored in each partition of the temperatures table
+# Must not change once partitions exist, as their date ranges would overlap
+TABLE_PARTITION_YEARS = int(os.environ.get('TABLE_PARTITION_YEARS', 10))
+
+# Columns of the temperatures table written by the load, and the transformed data frame columns holding them
+LOAD_COLUMNS = ['city_id', 'avgtemp', 'quarter', 'date']
+FRAME_COLUMNS = ['CityId', 'AvgTemperature', 'Quarter', 'Date']
+
+# Extraction settings
+# - EXTRACT_MODE: 'full' reads the whole source in memory, 'stream' reads it in chunks and keeps only monthly aggregates
+# - EXTRACT_CHUNK_SIZE: number of source rows read per chunk in stream mode
+EXTRACT_MODE = os.environ.get('EXTRACT_MODE', 'full')
+EXTRACT_CHUNK_SIZE = int(os.environ.get('EXTRACT_CHUNK_SIZE', 500000))
+
+# Parts of the source file city_temperature.csv
+SOURCE_FILES = ["etl/city_temperature-1.csv", "etl/city_temperature-2.csv"]
+
+# Source cache settings
+# - ETL_CACHE: keep a columnar (Arrow IPC) copy of each parsed source part, used in full mode
+# - ETL_CACHE_DIR: directory where the cached parts are kept
+# - ETL_CACHE_REBUILD: parse the source parts again even if the cache is still valid
+ETL_CACHE = os.environ.get('ETL_CACHE', 'true') == 'true'
+ETL_CACHE_DIR = os.environ.get('ETL_CACHE_DIR', 'etl/cache')
+ETL_CACHE_REBUILD = os.environ.get('ETL_CACHE_REBUILD', 'false') == 'true'
+
+# Number of source rows per block of the sidecar index of each source part
+# Blocks whose months were all loaded before are skipped without being parsed
+ETL_INDEX_BLOCK_ROWS = int(os.environ.get('ETL_INDEX_BLOCK_ROWS', 1000))
+
+# Datatypes used to read the source in full mode
+# The text columns repeat a few thousand names, so they are kept as categories, stored dictionary encoded in the cache
+SOURCE_DTYPE = {
+    "Region": "category",
+    "Country": "category",
+    "State": "category",
+    "City": "category",
+    "Month": int,
+    "Day": int,
+    "Year": int,
+    "AvgTemperature": float}
+
+# Text columns of the source, read as categories
+CATEGORY_COLUMNS = ['Region', 'Country', 'State', 'City']
+
+# Compact datatypes used to read the source in stream mode
+COMPACT_DTYPE = {
+    "Region": "category",
+    "Country": "category",
+    "State": "category",
+    "City": "category",
+    "Month": "int8",
+    "Day": "int8",
+    "Year": "int16",
+    "AvgTemperature": "float32"}
+
+# Columns identifying one monthly aggregate
+MONTH_KEYS = ['Region', 'Country', 'City', 'Year', 'Month']
+
+# Rollup tables kept up to date with the running sum and count of the monthly temperatures, by their key columns
+ROLLUPS = {
+    "temperature_quarter": ['city_id', 'quarter'],
+    "temperature_city_year": ['city_id', 'year', 'quarter'],
+    "temperature_country_month": ['region', 'country', 'date'],
+    "temperature_region_month": ['region', 'date']}
+
+# Rollups by area and month, touched by every partition, so they are refreshed once after all partitions are loaded
+AREA_ROLLUPS = ["temperature_country_month", "temperature_region_month"]
+
+# Datatypes of the rollup key columns
+ROLLUP_DTYPE = {
+    "city_id": "int",
+    "region": "varchar(50)",
+    "country": "varchar(30)",
+    "year": "int",
+    "quarter": "smallint",
+    "date": "date"}
+
+# City ids known to this process by region, country and city name
+cityIds = {}
+
+class LoadError(Exception):
+    '''
+    Failure to load a chunk, keeping the first date of the chunk so the watermark stays before it
+    '''
+    def __init__(self, failedFrom):
+        # Passed on as the only argument, so the error keeps its date when sent back from a worker process
+        super().__init__(failedFrom)
+        self.failedFrom = failedFrom
+
+    def __str__(self):
+        return f"Load failed from {self.failedFrom}"
+
 def createTable():
     '''
     Create the initial tables required by the ETL process
-        - temperatures table to store the main data
-        - status table to store process status
+        - city table to store the region, country and name of each city once, under an integer id
+        - temperatures table to store the main data by city id, partitioned by periods of years
+        - rollup tables to store running sums of the temperatures by quarter, year, country and region
+        - status tables to store process status (see dbstatus.createTable)
     '''
-    # Open connection to the database
-    connection = psycopg2.connect(f"host='{dbconfig.HOST}' dbname='{dbconfig.DBNAME}' user='{dbconfig.USER}' password='{dbconfig.PASSWORD}'")
-    mycursor = connection.cursor()
-    
-    # Create table to store the temperatures data and status information
+    # Create table to store each city once, referenced by the temperatures through its id
+    citySql = """
+        create table IF NOT EXISTS city (id serial primary key, region varchar(50), country varchar(30), city varchar(50),
+            unique (region, country, city));
+        """
+
+    # Create table to store the temperatures data, partitioned by date so queries and loads only touch the periods they need
+    tableSql = """
+        create table temperatures (city_id int, date date, quarter smallint, avgtemp real ) partition by range (date);
+        """
+
+    # Move the temperatures of a table created before the city table into a narrow copy, keeping one row per city and month
+    narrowSql = """
+        insert into city (region, country, city)
+            select distinct region, country, city from temperatures where date is not null
+        on conflict (region, country, city) do nothing;
+        create table temperatures_narrow as
+            select distinct on (c.id, t.date) c.id as city_id, t.date, cast(t.quarter as smallint) as quarter, cast(t.avgtemp as real) as avgtemp
+            from temperatures t join city c on c.region = t.region and c.country = t.country and c.city = t.city
+            where t.date is not null
+            order by c.id, t.date;
+        drop table temperatures cascade;
+        """
+
+    # Widen the city ids of tables created with small integer ids, which only held 32,767 cities
+    widenSql = f"""
+        alter table city alter column id type int;
+        alter sequence city_id_seq as int;
+        alter table temperatures alter column city_id type int;
+        {''.join(f'alter table IF EXISTS {table} alter column city_id type int;' for table, keys in ROLLUPS.items() if 'city_id' in keys)}
+        """
+
+    # Index supporting the paginated and filtered queries of the visualization data service
     sql = """
-        create table IF NOT EXISTS temperatures (region varchar(50), country varchar(30), city varchar(50), quarter int, date date, avgtemp decimal );
-        create table IF NOT EXISTS status (id SERIAL, status int, message varchar(40), timestamp timestamp, lastloaded date );
+        create index IF NOT EXISTS temperatures_date on temperatures (date, city_id);
         """
-    
-    # Execute the SQL statement + commit or rollback
-    try:
-        mycursor.execute(sql)
-        connection.commit()
-    except:
-        connection.rollback()
-    
-    # Close connection
-    connection.close()
 
-def getLastDateLoaded():
-    ''''
-    Get the date of the last loaded temperature and clean incomplete loads
-    '''
-    # Open connection to the database
-    connection = psycopg2.connect(f"host='{dbconfig.HOST}' dbname='{dbconfig.DBNAME}' user='{dbconfig.USER}' password='{dbconfig.PASSWORD}'")
-    cursor = connection.cursor()
+    # Add the natural key of the temperatures, removing duplicates left by earlier loads first
+    # The rollups are dropped so they get rebuilt from the remaining temperatures
+    keySql = f"""
+        delete from temperatures a using temperatures b
+            where a.ctid < b.ctid and a.city_id = b.city_id and a.date = b.date;
+        create unique index temperatures_key on temperatures (city_id, date);
+        drop table IF EXISTS {', '.join(ROLLUPS)};
+        """
     
-    # Get the date of the last temperature loaded
-    cursor.execute("SELECT MAX(lastloaded) as lastloaded FROM status;")
-    lastLoaded = cursor.fetchone()[0]
+    # Create the status tables
+    dbstatus.createTable()
+
+    # Borrow a pooled connection to the database
+    with dbpool.connection() as connection:
+        mycursor = connection.cursor()
 
-    # If it's the first run, set an initial date and remove any incomplete loads from temperatures table
-    if lastLoaded is None:
-        lastLoaded = '1970-01-01'
         # Execute the SQL statement + commit or rollback
         try:
-            cursor.execute("delete from temperatures;")
+            mycursor.execute(citySql)
+
+            # Create the partitioned temperatures table, moving the data of a table storing the city names into it
+            # This also converts a table created before partitioning
+            mycursor.execute("select to_regclass('temperatures');")
+            if mycursor.fetchone()[0] is None:
+                mycursor.execute(tableSql)
+            else:
+                mycursor.execute("select attname from pg_attribute where attrelid = to_regclass('temperatures') and attname = 'city_id';")
+                if mycursor.fetchone() is None:
+                    mycursor.execute(narrowSql)
+                    mycursor.execute(tableSql)
+                    mycursor.execute("select distinct cast(extract(year from date) as int) from temperatures_narrow;")
+                    createTablePartitions(mycursor, [row[0] for row in mycursor.fetchall()])
+                    mycursor.execute("""
+                        insert into temperatures (city_id, date, quarter, avgtemp)
+                            select city_id, date, quarter, avgtemp from temperatures_narrow;
+                        drop table temperatures_narrow;
+                        """)
+
+            mycursor.execute("select attname from pg_attribute where attrelid = to_regclass('city') and attname = 'id' and atttypid = 'smallint'::regtype;")
+            if mycursor.fetchone() is not None:
+                mycursor.execute(widenSql)
+
+            mycursor.execute(sql)
+            mycursor.execute("select to_regclass('temperatures_key');")
+            if mycursor.fetchone()[0] is None:
+                mycursor.execute(keySql)
+            for table, keys in ROLLUPS.items():
+                mycursor.execute("select to_regclass(%s);", (table,))
+                if mycursor.fetchone()[0] is None:
+                    mycursor.execute(rollupSql(table, keys))
             connection.commit()
         except:
             connection.rollback()
-    
-    # Close database connection
-    connection.close()
+
+def rollupSql(table, keys):
+    '''
+    Get the SQL statements creating a rollup table, filled from any temperatures already loaded
+    '''
+    columns = ', '.join(keys)
+    return f"""
+        create table {table} ({', '.join(f'{key} {ROLLUP_DTYPE[key]}' for key in keys)}, sumtemp decimal, counttemp int,
+            primary key ({columns}));
+        insert into {table}
+            select {columns}, sum(cast(avgtemp as numeric)), count(*)
+            from (select t.*, c.region, c.country, cast(extract(year from t.date) as int) as year
+                from temperatures t join city c on c.id = t.city_id) t
+            group by {columns};
+        """
+
+def getCityIds(cursor, data):
+    '''
+    Get the city id of each row of a transformed data frame without committing
+        - ids are looked up in the cache of the process, only unknown cities are sent to the database
+        - unknown cities are added to the city table, then the cache is refreshed from it
+    '''
+    keys = pandas.MultiIndex.from_frame(data[['Region', 'Country', 'City']])
+    missing = [key for key in keys.unique() if key not in cityIds]
+
+    if missing:
+        psycopg2.extras.execute_values(cursor, """insert into city (region, country, city) values %s
+            on conflict (region, country, city) do nothing""", missing, page_size=1000)
+        cursor.execute("select region, country, city, id from city;")
+        cityIds.update({(region, country, city): id for region, country, city, id in cursor.fetchall()})
+
+    return pandas.Series(cityIds).reindex(keys).values.astype("int32")
+
+def createTablePartitions(cursor, years):
+    '''
+    Create the partitions of the temperatures table covering the given years, if not already created
+    Each partition holds TABLE_PARTITION_YEARS years, named after its first year
+    '''
+    for start in sorted({year - year % TABLE_PARTITION_YEARS for year in years}):
+        cursor.execute(f"""create table IF NOT EXISTS temperatures_{start} partition of temperatures
+            for values from ('{start}-01-01') to ('{start + TABLE_PARTITION_YEARS}-01-01');""")
+
+def getLastDateLoaded():
+    ''''
+    Get the date of the last loaded temperature
+    Incomplete loads don't need to be cleaned up, as loading the same rows again updates them in place
+    '''
+    # Get the date of the last temperature loaded, kept in the current state of the ETL process
+    lastLoaded = dbstatus.getLastDateLoaded()
+
+    # If it's the first run, set an initial date
+    if lastLoaded is None:
+        lastLoaded = '1970-01-01'
 
     # Return last loaded date
     return lastLoaded
 
+def getLoadStart():
+    '''
+    Get the first date to load, one month after the last date loaded
+    '''
+    # Get last loaded timestamp
+    lastLoaded = str(getLastDateLoaded())
+    lastLoaded = datetime.strptime(lastLoaded, '%Y-%m-%d')
+
+    # Add 1 month to the last loaded date to use as filter for the next load
+    return lastLoaded + relativedelta(months=1)
+
+def loadChunk(cursor, chunk, mode=LOAD_MODE, table="temperatures"):
+    '''
+    Write a chunk of transformed data to a table without committing
+        - copy mode streams the chunk as CSV through COPY FROM STDIN
+        - values mode sends the chunk as batched multi-row INSERT statements
+    '''
+    columns = ", ".join(LOAD_COLUMNS)
+
+    if mode == 'copy':
+        # Serialize the chunk as CSV in memory and stream it to the database
+        buffer = io.StringIO()
+        chunk.to_csv(buffer, index=False, header=False, date_format='%Y-%m-%d')
+        buffer.seek(0)
+        cursor.copy_expert(f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+    elif mode == 'values':
+        # Send the chunk as multi-row INSERT statements
+        rows = list(chunk.itertuples(index=False, name=None))
+        psycopg2.extras.execute_values(cursor, f"INSERT INTO {table} ({columns}) VALUES %s", rows, page_size=1000)
+    else:
+        raise ValueError(f"Unknown load mode: {mode}")
+
+def aggregateSource(path, partial=None, chunkSize=EXTRACT_CHUNK_SIZE, start=0):
+    '''
+    Read a source file in chunks and accumulate its monthly temperature sums and counts
+        - -99 temperatures are skipped as they indicate data is not available
+        - only months from start on (see getMonthKey) are read
+        - partial aggregates from previous files can be passed in to be extended
+    '''
+    for chunk in pandas.read_csv(openSource(path, start), dtype=COMPACT_DTYPE, usecols=MONTH_KEYS + ['AvgTemperature'], chunksize=chunkSize):
+        # Remove missing temperatures and months loaded before, and sum them by month in double precision
+        chunk = chunk[(chunk.AvgTemperature != -99) & (getMonthKey(chunk.Year.astype(int), chunk.Month.astype(int)) >= start)]
+        chunk = chunk.astype({"AvgTemperature": "float64"})
+        chunk = chunk.groupby(MONTH_KEYS, observed=True)['AvgTemperature'].agg(['sum', 'count'])
+
+        # Merge the chunk into the running aggregates
+        if partial is None:
+            partial = chunk
+        else:
+            partial = pandas.concat([partial, chunk]).groupby(level=MONTH_KEYS, observed=True).sum()
+
+    return partial
+
+def mergeStaging(cursor):
+    '''
+    Merge the chunk staged in temperatures_staging into the temperatures table and the city rollups without committing
+        - rows already loaded are updated in place, so loading the same data again is safe
+        - rollup sums are adjusted by the difference with the temperatures loaded before
+        - only the table partitions from the first staged date on are searched for rows loaded before
+    All parts of the statement see the temperatures as they were before the chunk
+    Partitions hold different cities, so their merges don't lock the same rows; the area rollups are left to refreshAreaRollups
+    '''
+    rollups = "".join(f"""
+        , {table}_merge as (
+            insert into {table} ({', '.join(keys)}, sumtemp, counttemp)
+                select {', '.join(keys)}, sum(difftemp), sum(newrow) from delta group by {', '.join(keys)}
+            on conflict ({', '.join(keys)}) do update
+                set sumtemp = {table}.sumtemp + excluded.sumtemp, counttemp = {table}.counttemp + excluded.counttemp)"""
+        for table, keys in ROLLUPS.items() if table not in AREA_ROLLUPS)
+
+    cursor.execute(f"""
+        with delta as (
+            select s.city_id, s.quarter, s.date, cast(extract(year from s.date) as int) as year,
+                cast(s.avgtemp as numeric) - coalesce(cast(t.avgtemp as numeric), 0) as difftemp, cast(t.date is null as int) as newrow
+            from temperatures_staging s left join temperatures t
+                on t.city_id = s.city_id and t.date = s.date
+                and t.date >= (select min(date) from temperatures_staging))
+        {rollups}
+        insert into temperatures (city_id, date, quarter, avgtemp)
+            select city_id, date, quarter, avgtemp from temperatures_staging
+        on conflict (city_id, date) do update
+            set quarter = excluded.quarter, avgtemp = excluded.avgtemp;
+        """)
+
+def refreshAreaRollups(cursor, start):
+    '''
+    Rebuild the months of the area rollups from the given date on, from the temperatures table, without committing
+    The rollups are keyed by date, so the rebuilt months replace the old ones exactly
+    '''
+    for table in AREA_ROLLUPS:
+        columns = ', '.join(ROLLUPS[table])
+        cursor.execute(f"""
+            delete from {table} where date >= %(start)s;
+            insert into {table} ({columns}, sumtemp, counttemp)
+                select {columns}, sum(cast(avgtemp as numeric)), count(*)
+                from (select t.*, c.region, c.country
+                    from temperatures t join city c on c.id = t.city_id where t.date >= %(start)s) t
+                group by {columns};
+            """, {"start": start})
+
+def getFileHash(path):
+    '''
+    Get the SHA-256 hash of a file, reading it in blocks
+    '''
+    sha = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def isCacheValid(path, metadataPath):
+    '''
+    Check whether the cached copy of a source part still matches the source file
+        - a matching size and modification time is trusted
+        - when only the modification time changed, the content hash decides
+    '''
+    try:
+        with open(metadataPath) as file:
+            metadata = json.load(file)
+    except (OSError, ValueError):
+        return False
+
+    stat = os.stat(path)
+    if metadata["size"] != stat.st_size:
+        return False
+    if metadata["mtime"] == stat.st_mtime_ns:
+        return True
+    if metadata["sha256"] != getFileHash(path):
+        return False
+
+    # Same content with a new modification time, remember it to skip hashing next time
+    metadata["mtime"] = stat.st_mtime_ns
+    with open(metadataPath, "w") as file:
+        json.dump(metadata, file)
+    return True
+
+def getMonthKey(year, month):
+    '''
+    Get a number identifying a month, increasing by one from each month to the next
+    Works on single values as well as on whole columns
+    '''
+    return year * 12 + month - 1
+
+def buildSourceIndex(path, indexPath):
+    '''
+    Build the sidecar index of a source part, scanning its lines without parsing them as CSV
+        - the part is split in blocks of ETL_INDEX_BLOCK_ROWS rows
+        - each block records its byte range and its first and last month (see getMonthKey)
+        - the size, modification time and hash of the part are kept to check the index is still valid
+    '''
+    blocks = []
+    stat = os.stat(path)
+    with open(path, "rb") as file:
+        header = file.readline()
+        offset = start = len(header)
+        rows = 0
+        first = last = None
+        for line in file:
+            if line.strip():
+                # Month, Day, Year and AvgTemperature are the last columns
+                fields = line.rsplit(b",", 4)
+                key = getMonthKey(int(fields[-2]), int(fields[-4]))
+                first = key if first is None else min(first, key)
+                last = key if last is None else max(last, key)
+                rows += 1
+            offset += len(line)
+
+            if rows == ETL_INDEX_BLOCK_ROWS:
+                blocks.append([start, offset, first, last])
+                start = offset
+                rows = 0
+                first = last = None
+
+        if rows:
+            blocks.append([start, offset, first, last])
+
+    index = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "sha256": getFileHash(path), "header": len(header), "blocks": blocks}
+    os.makedirs(ETL_CACHE_DIR, exist_ok=True)
+    with open(indexPath + ".tmp", "w") as file:
+        json.dump(index, file)
+    os.replace(indexPath + ".tmp", indexPath)
+
+    return index
+
+def getSourceIndex(path):
+    '''
+    Get the sidecar index of a source part, rebuilding it when the source file changed
+    '''
+    indexPath = os.path.join(ETL_CACHE_DIR, os.path.basename(path) + ".index.json")
+    if not ETL_CACHE_REBUILD and isCacheValid(path, indexPath):
+        with open(indexPath) as file:
+            return json.load(file)
+
+    return buildSourceIndex(path, indexPath)
+
+def openSource(path, start=0):
+    '''
+    Open a source part for reading only the blocks holding months from start on
+    Returns the path itself when no block can be skipped, otherwise an in-memory copy of the header and the selected blocks
+    The selected blocks can still hold older months, which have to be filtered out after parsing
+    '''
+    if not start:
+        return path
+
+    index = getSourceIndex(path)
+    blocks = [(begin, end) for begin, end, first, last in index["blocks"] if last >= start]
+    if len(blocks) == len(index["blocks"]):
+        return path
+
+    # Join adjacent blocks into ranges read at once
+    ranges = []
+    for begin, end in blocks:
+        if ranges and ranges[-1][1] == begin:
+            ranges[-1][1] = end
+        else:
+            ranges.append([begin, end])
+
+    buffer = io.BytesIO()
+    with open(path, "rb") as file:
+        buffer.write(file.read(index["header"]))
+        for begin, end in ranges:
+            file.seek(begin)
+            buffer.write(file.read(end - begin))
+    buffer.seek(0)
+
+    return buffer
+
+def readSource(path, start=0):
+    '''
+    Read a source part, from the columnar cache when it still matches the source file
+    Only months from start on (see getMonthKey) are returned
+    '''
+    if not ETL_CACHE:
+        data = pandas.read_csv(openSource(path, start), dtype=SOURCE_DTYPE)
+        return data[getMonthKey(data.Year, data.Month) >= start]
+
+    cachePath = os.path.join(ETL_CACHE_DIR, os.path.basename(path) + ".arrow")
+    metadataPath = cachePath + ".json"
+
+    # Memory-map the cached copy instead of parsing the text file
+    # The dictionary encoded text columns are read as categories; copies storing plain strings are rebuilt
+    if not ETL_CACHE_REBUILD and isCacheValid(path, metadataPath):
+        table = pyarrow.feather.read_table(cachePath, memory_map=True)
+        if all(pyarrow.types.is_dictionary(table.schema.field(column).type) for column in CATEGORY_COLUMNS):
+            if start:
+                monthKey = pyarrow.compute.add(pyarrow.compute.multiply(table["Year"], 12), pyarrow.compute.subtract(table["Month"], 1))
+                table = table.filter(pyarrow.compute.greater_equal(monthKey, start))
+            return table.to_pandas()
+
+    # Parse the source part and rebuild its cached copy, invalidating the previous one first
+    if os.path.exists(metadataPath):
+        os.remove(metadataPath)
+    stat = os.stat(path)
+    data = pandas.read_csv(path, dtype=SOURCE_DTYPE)
+    os.makedirs(ETL_CACHE_DIR, exist_ok=True)
+    pyarrow.feather.write_feather(data, cachePath + ".tmp", compression="uncompressed")
+    os.replace(cachePath + ".tmp", cachePath)
+    with open(metadataPath, "w") as file:
+        json.dump({"size": stat.st_size, "mtime": stat.st_mtime_ns, "sha256": getFileHash(path)}, file)
+
+    return data[getMonthKey(data.Year, data.Month) >= start]
+
+def concatSources(parts):
+    '''
+    Join the parts read from the source, keeping the text columns as categories over the names of all parts
+    '''
+    for column in CATEGORY_COLUMNS:
+        categories = pandas.api.types.union_categoricals([part[column] for part in parts]).categories
+        parts = [part.assign(**{column: part[column].cat.set_categories(categories)}) for part in parts]
+
+    return pandas.concat(parts, ignore_index=True)
+
+@task
+@dbmetrics.measure("etl")
+def getWatermark():
+    '''
+    Task to get the first date to load before extracting, so only newer months are extracted and transformed
+    '''
+    return getLoadStart()
+
 @task(max_retries=3, retry_delay=timedelta(seconds=1))
-def extract():
+@dbmetrics.measure("etl")
+def extract(lastLoaded):
     ''''
-    Task to extract the source data from 2 parts of the file city_temperature.csv
+    Task to extract the source data from the parts of the file city_temperature.csv
+    Only the months from the first date to load on are extracted
     '''
     # Log status message
     dbstatus.logStatus(1, "ETL 1/7 - Extraction started")
+    start = getMonthKey(lastLoaded.year, lastLoaded.month)
+
+    # In stream mode only the monthly averages are kept in memory
+    if EXTRACT_MODE == 'stream':
+        partial = None
+        for path in SOURCE_FILES:
+            partial = aggregateSource(path, partial, start=start)
+
+        # Nothing to aggregate when all months were loaded before
+        if partial is None:
+            partial = pandas.DataFrame(columns=MONTH_KEYS + ['sum', 'count']).set_index(MONTH_KEYS)
+
+        # Turn the running sums into monthly averages
+        data = (partial['sum'] / partial['count']).rename('AvgTemperature').reset_index()
+        data = data.astype({"Region": "string", "Country": "string", "City": "string", "Year": int, "Month": int})
 
-    # Set dataframe datatypes
-    dtype={ "Region": "string", 
-            "Country": "string", 
-            "State": "string", 
-            "City": "string", 
-            "Month": int, 
-            "Day": int, 
-            "Year": int, 
-            "AvgTemperature": float}
-
-    # Read both parts of the file
-    data1 = pandas.read_csv(
-        "etl/city_temperature-1.csv", 
-        dtype=dtype)
-    data2 = pandas.read_csv(
-        "etl/city_temperature-2.csv", 
-        dtype=dtype)
-
-    # Join both parts in the same data frame
-    data = pandas.concat([data1, data2])
+        # Log status message
+        dbstatus.logStatus(1, "ETL 2/7 - Extraction completed")
+
+        return data
+
+    # Read all parts of the file and join them in the same data frame
+    data = concatSources([readSource(path, start) for path in SOURCE_FILES])
 
     # Log status message
     dbstatus.logStatus(1, "ETL 2/7 - Extraction completed")
@@ -98,46 +597,29 @@ def extract():
     # Return data from source
     return data
 
-@task
-def transform(data):
-    ''''
-    Task to transform the source data
+def transformData(data):
+    '''
+    Transform the source data into monthly averages per city
+        - all derived columns are computed on whole columns at once
     '''
-    # Log status message
-    dbstatus.logStatus(1, "ETL 3/7 - Transformation started")
-
     # Remove -99 temperatures as it indicates data is not available
-    data = data.drop(data[data.AvgTemperature == -99].index)
+    data = data[data.AvgTemperature != -99]
 
-    # Remove State and Day columns
-    data = data.drop(columns=['State', 'Day'])
+    # Remove State and Day columns (already gone when extracted in stream mode)
+    data = data.drop(columns=['State', 'Day'], errors='ignore')
 
     # Average temperatures by month rather than days 
-    data = data.groupby(['Region','Country','City','Year','Month'], as_index=False).mean()
-
-    # Convert Temperature from F to C
-    data['AvgTemperature'] = (data['AvgTemperature'] - 32) * 5 / 9
-
-    # Change temperatures precision to 2 decimal places
-    data['AvgTemperature'] = data['AvgTemperature'].round(decimals = 2)
-
-    # Add a column for Quarter
-    def setQuarter(month):
-        quarter = 0
-        if month <= 3:
-            quarter = 1
-        elif month <= 6:
-            quarter = 2
-        elif month <= 9:
-            quarter = 3
-        elif month <= 12:
-            quarter = 4
-        return quarter
-    data['Quarter'] = data.apply(lambda x : setQuarter(x['Month']) , axis=1)
-
-    # Join Year and Month as a new Date column
-    data["Date"] = data["Year"].astype(str) + "-" + data["Month"].astype(str) + "-01"
-    data["Date"] = pandas.to_datetime(data["Date"])
+    # Only the cities and months present are kept, as the names can be categories
+    data = data.groupby(MONTH_KEYS, as_index=False, observed=True).mean()
+
+    # Convert Temperature from F to C with a precision of 2 decimal places
+    data['AvgTemperature'] = ((data['AvgTemperature'].astype(float) - 32) * 5 / 9).round(decimals = 2)
+
+    # Add a column for Quarter derived from the month
+    data['Quarter'] = (data['Month'].astype(int) - 1) // 3 + 1
+
+    # Build a Date column on the first day of each Year and Month
+    data['Date'] = pandas.to_datetime(pandas.DataFrame({"year": data['Year'], "month": data['Month'], "day": 1}))
 
     # Remove Year and Month columns
     data = data.drop(columns=['Year', 'Month'])
@@ -145,72 +627,285 @@ def transform(data):
     # Sort data by Date
     data = data.sort_values(by="Date")
 
-    # Log status message
-    dbstatus.logStatus(1, "ETL 4/7 - Transformation completed")
-
     # Return transformed data
     return data
 
 @task
-def load(data):
-    ''''
-    Task to load the processed data into the database
+@dbmetrics.measure("etl")
+def partition(data):
+    '''
+    Task to split the source data into partitions that can be transformed and loaded in parallel
+        - all rows of a city end up in the same partition, so monthly averages stay complete
     '''
     # Log status message
+    dbstatus.logStatus(1, "ETL 3/7 - Transformation started")
+
+    # Assign each city to a partition by hashing its region, country and name
+    key = pandas.util.hash_pandas_object(data[['Region', 'Country', 'City']], index=False) % ETL_PARTITIONS
+
+    # Return non-empty partitions
+    return [part for _, part in data.groupby(key.values)]
+
+@task
+@dbmetrics.measure("etl")
+def transform(data):
+    ''''
+    Task to transform one partition of the source data
+    '''
+    # Aggregate, convert and enrich the source data
+    return transformData(data)
+
+@task
+@dbmetrics.measure("etl")
+def prepareLoad(data, lastLoaded):
+    '''
+    Task to prepare the tables for the load, once all partitions are transformed
+    Returns the date from which data should be loaded
+    '''
+    # Log status messages
+    dbstatus.logStatus(1, "ETL 4/7 - Transformation completed")
     dbstatus.logStatus(1, "ETL 5/7 - Loading started")
 
-    # Get last loaded timestamp
-    lastLoaded = str(getLastDateLoaded())
-    lastLoaded = datetime.strptime(lastLoaded, '%Y-%m-%d')
-    
-    # Add 1 month to the last loaded date to use as filter for the next load
-    lastLoaded = lastLoaded + relativedelta(months=1)
-    
+    # Create the table partitions for the years about to be loaded
+    years = set()
+    for part in data:
+        years.update(part.Date[part.Date >= lastLoaded].dt.year.unique().tolist())
+
+    with dbpool.connection() as connection:
+        createTablePartitions(connection.cursor(), years)
+        connection.commit()
+
+    return lastLoaded
+
+@task(max_retries=3, retry_delay=timedelta(seconds=1))
+@dbmetrics.measure("etl")
+def load(data, lastLoaded):
+    ''''
+    Task to load one processed partition into the database
+    Returns the number of rows loaded and the latest date loaded
+    A failed chunk is rolled back and raised as a LoadError, so the task is retried, loading the partition again
+    '''
     # Filter out already loaded data
     data = data[data.Date >= lastLoaded]
     
-    # Connect to the database
-    connection = psycopg2.connect(f"host='{dbconfig.HOST}' dbname='{dbconfig.DBNAME}' user='{dbconfig.USER}' password='{dbconfig.PASSWORD}'")
-    mycursor = connection.cursor()
-
     # Add counter to log number of rows loaded
     loadCounter = 0
 
-    # Iterate through each row and insert to the database
-    for index, row in data.iterrows():
-        # Prepare SQL query to INSERT a record into the database.
-        sql = "INSERT INTO temperatures (region, country, city, avgtemp, quarter, date) VALUES ('%s', '%s', '%s', '%s', '%s', '%s');" % (row[0], row[1], row[2], row[3], row[4], row[5])
-        
-        # Execute SQL statement + commit or rollback
-        try:
-            mycursor.execute(sql)
+    # Borrow a pooled connection to the database
+    with dbpool.connection() as connection:
+        mycursor = connection.cursor()
+
+        # Create the session's staging table, emptied at the end of every transaction
+        mycursor.execute("create temp table IF NOT EXISTS temperatures_staging (like temperatures) on commit delete rows;")
+        connection.commit()
+
+        # Replace the city names by their ids, committing new cities before any chunk refers to them
+        if not data.empty:
+            data = data.assign(CityId=getCityIds(mycursor, data))
             connection.commit()
+        data = data.reindex(columns=FRAME_COLUMNS)
 
-            # Always keep record of the latest date processed
-            if lastLoaded < row[5]:
-                lastLoaded = row[5]
+        # Write the data in chunks, each one staged and merged in its own transaction
+        for start in range(0, len(data), LOAD_CHUNK_SIZE):
+            chunk = data.iloc[start:start + LOAD_CHUNK_SIZE]
 
-            # Count loaded row
-            loadCounter = loadCounter+1
-        
-        except:
-            connection.rollback()
+            # Execute SQL statement + commit or rollback
+            try:
+                loadChunk(mycursor, chunk, LOAD_MODE, "temperatures_staging")
+                mergeStaging(mycursor)
+                connection.commit()
+
+                # Always keep record of the latest date processed
+                if lastLoaded < chunk.Date.max():
+                    lastLoaded = chunk.Date.max()
+
+                # Count loaded rows
+                loadCounter = loadCounter + len(chunk)
+
+            except Exception as error:
+                connection.rollback()
+                raise LoadError(chunk.Date.min()) from error
 
-    # Close database connection
-    connection.close()
+    return loadCounter, lastLoaded
 
+@task(trigger=all_finished)
+@dbmetrics.measure("etl")
+def completeLoad(results, loadStart):
+    ''''
+    Task to log the outcome of the load once all partitions are loaded or failed
+    The area rollups are refreshed from the first date loaded, in a single step for all partitions
+    The last date loaded is kept before the earliest month that failed to load, so the next run loads it again
+    A run that failed without loading anything doesn't log the completed status, so the ML and visualization aren't woken up
+    '''
     # Log status message
     dbstatus.logStatus(1, "ETL 6/7 - Loading completed")
 
+    # Failed partitions are passed in as their exception
+    if isinstance(results, BaseException):
+        results = [results]
+    failures = [result for result in results if isinstance(result, BaseException)]
+    results = [result for result in results if not isinstance(result, BaseException)]
+
+    # Add up the rows and keep the latest date loaded across partitions
+    loadCounter = sum(count for count, _ in results)
+    lastLoaded = max((date for _, date in results), default='')
+
     # If nothing was loaded, last loaded date won't be logged
     if loadCounter == 0:
         lastLoaded = ''
+
+    # Keep the last date loaded before the first failed month, or don't move it when the failed month is unknown
+    failedFrom = [getattr(failure, "failedFrom", None) for failure in failures]
+    if None in failedFrom:
+        lastLoaded = ''
+    elif failedFrom and lastLoaded != '':
+        lastLoaded = min(lastLoaded, min(failedFrom) - relativedelta(months=1))
+
+    # Refresh the area rollups over the months loaded, unless the load didn't start
+    if not isinstance(loadStart, BaseException):
+        with dbpool.connection() as connection:
+            mycursor = connection.cursor()
+
+            # Execute SQL statement + commit or rollback
+            try:
+                refreshAreaRollups(mycursor, loadStart)
+                connection.commit()
+            except:
+                connection.rollback()
+                raise
     
-    # Log status message
-    dbstatus.logStatus(2, f"ETL 7/7 - Loaded {loadCounter} rows", lastLoaded)
+    # Log status message, only signalling completion when some data was loaded or nothing failed
+    if failures and loadCounter == 0:
+        dbstatus.logStatus(1, "ETL 7/7 - Load failed", lastLoaded)
+    else:
+        dbstatus.logStatus(2, f"ETL 7/7 - Loaded {loadCounter} rows", lastLoaded)
+
+    if failures:
+        raise signals.FAIL(f"{len(failures)} partitions failed to load")
     
     return "--- Process successfully completed! ---"
 
+@task(max_retries=3, retry_delay=timedelta(seconds=1))
+@dbmetrics.measure("etl")
+def extractRaw(lastLoaded):
+    ''''
+    Task to copy the daily rows of the parts of the file city_temperature.csv into the temperatures_raw table
+    The table is unlogged, as it is refilled on every run, but not temporary, so the transformation can be run by parallel workers
+    Blocks of the parts holding only months before the first date to load are not copied
+    Returns the number of rows copied
+    '''
+    # Log status message
+    dbstatus.logStatus(1, "ETL 1/7 - Extraction started")
+
+    # Borrow a pooled connection to the database
+    with dbpool.connection() as connection:
+        mycursor = connection.cursor()
+
+        # Execute SQL statement + commit or rollback
+        try:
+            mycursor.execute("""
+                create unlogged table IF NOT EXISTS temperatures_raw (region text, country text, state text, city text,
+                    month int, day int, year int, avgtemperature double precision );
+                truncate temperatures_raw;
+                """)
+
+            # Stream each part of the file straight from disk, or the blocks holding new months
+            start = getMonthKey(lastLoaded.year, lastLoaded.month)
+            for path in SOURCE_FILES:
+                source = openSource(path, start)
+                if source == path:
+                    source = open(path, "rb")
+                with source as file:
+                    mycursor.copy_expert("COPY temperatures_raw FROM STDIN WITH (FORMAT csv, HEADER true)", file)
+            connection.commit()
+        except:
+            connection.rollback()
+            raise
+
+        # Update the planner statistics of the new rows
+        mycursor.execute("analyze temperatures_raw;")
+        connection.commit()
+        mycursor.execute("select count(*) from temperatures_raw;")
+        rows = mycursor.fetchone()[0]
+
+    # Log status message
+    dbstatus.logStatus(1, "ETL 2/7 - Extraction completed")
+
+    return rows
+
+@task
+@dbmetrics.measure("etl")
+def transformLoad(rows, lastLoaded):
+    ''''
+    Task to transform the raw daily rows into monthly averages inside the database and load them
+        - the same steps as transformData, written as a single aggregate query
+        - the monthly averages are written with create table as, so the query can use parallel workers
+        - only months after the last date loaded are transformed
+    Returns the number of rows loaded and the latest date loaded
+    '''
+    # Log status message
+    dbstatus.logStatus(1, "ETL 3/7 - Transformation started")
+
+    # Remove -99 temperatures, average by month, convert from F to C and add quarter and date
+    transformSql = """
+        drop table IF EXISTS temperatures_monthly;
+        create unlogged table temperatures_monthly as
+            select region, country, city, (month - 1) / 3 + 1 as quarter, make_date(year, month, 1) as date,
+                round(cast((avg(avgtemperature) - 32) * 5 / 9 as numeric), 2) as avgtemp
+            from temperatures_raw
+            where avgtemperature <> -99 and region is not null and country is not null and city is not null
+                and make_date(year, month, 1) >= %s
+            group by region, country, city, year, month;
+        """
+
+    # Borrow a pooled connection to the database
+    with dbpool.connection() as connection:
+        mycursor = connection.cursor()
+
+        mycursor.execute(transformSql, (lastLoaded,))
+        connection.commit()
+
+        # Log status messages
+        dbstatus.logStatus(1, "ETL 4/7 - Transformation completed")
+        dbstatus.logStatus(1, "ETL 5/7 - Loading started")
+
+        # Execute SQL statement + commit or rollback
+        try:
+            # Create the table partitions for the years about to be loaded
+            mycursor.execute("select distinct cast(extract(year from date) as int) from temperatures_monthly;")
+            createTablePartitions(mycursor, [row[0] for row in mycursor.fetchall()])
+
+            # Add new cities, then stage the monthly averages by city id and merge them like a loaded chunk
+            mycursor.execute("""
+                insert into city (region, country, city)
+                    select distinct region, country, city from temperatures_monthly
+                on conflict (region, country, city) do nothing;
+                create temp table IF NOT EXISTS temperatures_staging (like temperatures) on commit delete rows;
+                insert into temperatures_staging (city_id, date, quarter, avgtemp)
+                    select c.id, m.date, m.quarter, m.avgtemp
+                    from temperatures_monthly m join city c on c.region = m.region and c.country = m.country and c.city = m.city;
+                """)
+            mycursor.execute("select count(*), max(date) from temperatures_staging;")
+            loadCounter, lastDate = mycursor.fetchone()
+            mergeStaging(mycursor)
+            mycursor.execute("drop table temperatures_monthly;")
+            connection.commit()
+        except:
+            connection.rollback()
+            raise
+
+    return loadCounter, lastDate or lastLoaded
+
+@task
+@dbmetrics.measure("etl")
+def compactStatus(result):
+    ''''
+    Task to roll the statuses of old runs up into run summaries, once the load is logged
+    '''
+    runs = dbstatus.compactStatus()
+
+    return f"{runs} runs compacted"
+
 def main():
     '''
     Set Prefect flow and execute schedule
@@ -230,16 +925,27 @@ def main():
     )
 
     # Configure Prefect flow
+    # In database mode the raw rows are copied to the database and transformed there, otherwise they are transformed by partition here
     with Flow("etl", schedule=schedule) as flow:
-        data = extract()
-        data = transform(data)
-        load(data)
+        lastLoaded = getWatermark()
+        if TRANSFORM_MODE == 'database':
+            rows = extractRaw(lastLoaded)
+            result = transformLoad(rows, lastLoaded)
+            result = completeLoad([result], lastLoaded)
+        else:
+            data = extract(lastLoaded)
+            partitions = partition(data)
+            data = transform.map(partitions)
+            lastLoaded = prepareLoad(data, lastLoaded)
+            results = load.map(data, unmapped(lastLoaded))
+            result = completeLoad(results, lastLoaded)
+        compactStatus(result)
 
     # Create database tables - if not already created
     createTable()
 
-    # Execute ETL flow
-    flow.run(executor=LocalDaskExecutor())
+    # Execute ETL flow, with one worker process per partition
+    flow.run(executor=LocalDaskExecutor(scheduler="processes", num_workers=ETL_PARTITIONS))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
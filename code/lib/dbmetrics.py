@@ -0,0 +1,181 @@
+import psycopg2.extras
+import dbpool
+from datetime import datetime
+import multiprocessing.util
+import functools
+import threading
+import resource
+import time
+import os
+
+# Metrics settings
+# - METRICS_BATCH_SIZE: number of buffered task metrics that triggers a write to the database
+# - METRICS_FLUSH_SECONDS: age of the oldest buffered task metrics that triggers a write to the database
+METRICS_BATCH_SIZE = int(os.environ.get('METRICS_BATCH_SIZE', 20))
+METRICS_FLUSH_SECONDS = int(os.environ.get('METRICS_FLUSH_SECONDS', 300))
+
+# Task metrics waiting to be written and whether the table was created by this process
+_buffer = []
+_lock = threading.Lock()
+_tableCreated = False
+
+def createTable():
+    '''
+    Create the task_metrics table storing timing and resource usage of each task run
+    '''
+    sql = """
+        create table IF NOT EXISTS task_metrics (id SERIAL primary key, flow varchar(20), task varchar(40), started timestamp,
+            wallseconds real, cpuseconds real, peakrssmb real, rowsin bigint, rowsout bigint, dbroundtrips int);
+        create index IF NOT EXISTS task_metrics_started on task_metrics (started);
+        """
+
+    # Borrow a pooled connection to the database
+    with dbpool.connection() as connection:
+        mycursor = connection.cursor()
+
+        # Execute the SQL statement + commit or rollback
+        try:
+            mycursor.execute(sql)
+
+            # The peak memory column of the previous version held the process peak, it now holds the peak of each task
+            mycursor.execute("select attname from pg_attribute where attrelid = to_regclass('task_metrics') and attname = 'processpeakrssmb';")
+            if mycursor.fetchone() is not None:
+                mycursor.execute("alter table task_metrics rename column processpeakrssmb to peakrssmb;")
+            connection.commit()
+        except:
+            connection.rollback()
+
+def countRows(value):
+    '''
+    Count the rows of a data frame, or of all data frames in a list or tuple
+    '''
+    if isinstance(value, (list, tuple)):
+        return sum(countRows(item) for item in value)
+    if hasattr(value, "shape") and hasattr(value, "columns"):
+        return len(value)
+    return 0
+
+def resetPeakMemory():
+    '''
+    Reset the peak resident memory of the process to its current size, on Linux
+    '''
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        pass
+
+def getPeakMemory():
+    '''
+    Get the peak resident memory of the process in MB, since the last reset on Linux
+    Elsewhere the peak of the whole process so far is returned
+    '''
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    # Reported in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def measure(flow):
+    '''
+    Decorator recording wall time, CPU time, peak memory, rows in and out and database round trips of a task
+    Runs that raise are recorded too, with no rows out
+    Metrics are buffered and written to the task_metrics table in batches
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = datetime.now()
+            wallStart = time.perf_counter()
+            # CPU time of all threads, including the worker threads of the libraries called by the task
+            cpuStart = time.process_time()
+            roundTripsStart = dbpool.getRoundTrips()
+            # Peak memory from the start of the task; tasks running alongside it in the same process are included
+            resetPeakMemory()
+            result = None
+
+            try:
+                result = function(*args, **kwargs)
+                return result
+            finally:
+                record({
+                    "flow": flow,
+                    "task": function.__name__,
+                    "started": started,
+                    "wallseconds": time.perf_counter() - wallStart,
+                    "cpuseconds": time.process_time() - cpuStart,
+                    "peakrssmb": getPeakMemory(),
+                    "rowsin": countRows(list(args) + list(kwargs.values())),
+                    "rowsout": countRows(result),
+                    "dbroundtrips": dbpool.getRoundTrips() - roundTripsStart,
+                })
+        return wrapper
+    return decorator
+
+def record(metrics):
+    '''
+    Buffer the metrics of one task run, writing the buffer once it is full or old enough
+    '''
+    with _lock:
+        _buffer.append(metrics)
+        due = len(_buffer) >= METRICS_BATCH_SIZE or (datetime.now() - _buffer[0]["started"]).total_seconds() >= METRICS_FLUSH_SECONDS
+
+    if due:
+        flush()
+
+def flush():
+    '''
+    Write all buffered task metrics to the database in one statement
+    '''
+    global _tableCreated
+
+    with _lock:
+        rows = [(m["flow"], m["task"], m["started"], m["wallseconds"], m["cpuseconds"], m["peakrssmb"], m["rowsin"], m["rowsout"], m["dbroundtrips"]) for m in _buffer]
+        _buffer.clear()
+
+    if not rows:
+        return
+
+    # Metrics must never fail a task, so they are dropped when the database can't be reached
+    try:
+        if not _tableCreated:
+            createTable()
+            _tableCreated = True
+
+        sql = "INSERT INTO task_metrics (flow, task, started, wallseconds, cpuseconds, peakrssmb, rowsin, rowsout, dbroundtrips) VALUES %s"
+
+        # Borrow a pooled connection to the database
+        with dbpool.connection() as connection:
+            mycursor = connection.cursor()
+
+            # Execute the SQL statement + commit or rollback
+            try:
+                psycopg2.extras.execute_values(mycursor, sql, rows)
+                connection.commit()
+            except:
+                connection.rollback()
+    except psycopg2.Error:
+        print(f"Could not write {len(rows)} task metrics")
+
+class _ProcessHook:
+    '''
+    Object the exit flush is attached to in each process
+    '''
+
+def _armExitFlush(hook=None):
+    '''
+    Write what is left in the buffer when the process exits
+    Worker processes start with an empty buffer, as their parent writes its own metrics
+    '''
+    _buffer.clear()
+    multiprocessing.util.Finalize(None, flush, exitpriority=10)
+
+# Arm the exit flush in this process and again in every multiprocessing worker
+_hook = _ProcessHook()
+_armExitFlush()
+multiprocessing.util.register_after_fork(_hook, _armExitFlush)
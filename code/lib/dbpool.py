@@ -0,0 +1,175 @@
+import psycopg2.extensions
+import psycopg2.pool
+import dbconfig
+from contextlib import contextmanager
+import threading
+import time
+import os
+
+# Connection string of the database
+DSN = f"host='{dbconfig.HOST}' dbname='{dbconfig.DBNAME}' user='{dbconfig.USER}' password='{dbconfig.PASSWORD}'"
+
+# Pool settings
+# - DB_POOL_MIN: connections kept open per process
+# - DB_POOL_MAX: maximum connections open at the same time per process
+POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+POOL_MAX = int(os.environ.get('DB_POOL_MAX', 4))
+
+# Pool, engine and metrics of the current process
+_pool = None
+_engine = None
+_owner = None
+_slots = None
+_lock = threading.Lock()
+_metrics = {"acquires": 0, "totalSeconds": 0.0, "maxSeconds": 0.0}
+
+# Statements sent to the database and time spent waiting for them, by each thread
+_roundTrips = threading.local()
+
+class CountingCursor(psycopg2.extensions.cursor):
+    '''
+    Cursor counting and timing the statements it sends to the database for the current thread
+    '''
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            _countRoundTrip(start)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            _countRoundTrip(start)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            _countRoundTrip(start)
+
+def _countRoundTrip(start):
+    '''
+    Count one statement sent to the database by the current thread and the time it took
+    '''
+    _roundTrips.count = getRoundTrips() + 1
+    _roundTrips.seconds = getDatabaseSeconds() + time.perf_counter() - start
+
+def getRoundTrips():
+    '''
+    Get the number of statements sent to the database by the current thread so far
+    '''
+    return getattr(_roundTrips, "count", 0)
+
+def getDatabaseSeconds():
+    '''
+    Get the time the current thread spent waiting for database statements so far
+    '''
+    return getattr(_roundTrips, "seconds", 0.0)
+
+def _reset():
+    '''
+    Drop pool and engine inherited from a parent process, as connections can't be shared across processes
+    '''
+    global _pool, _engine, _owner, _slots
+    if _owner != os.getpid():
+        _pool = None
+        _engine = None
+        _slots = threading.BoundedSemaphore(POOL_MAX)
+        _metrics.update(acquires=0, totalSeconds=0.0, maxSeconds=0.0)
+        _owner = os.getpid()
+
+def getPool():
+    '''
+    Get the process-wide psycopg2 connection pool, creating it on first use
+    '''
+    global _pool
+    with _lock:
+        _reset()
+        if _pool is None:
+            _pool = psycopg2.pool.ThreadedConnectionPool(POOL_MIN, POOL_MAX, DSN, cursor_factory=CountingCursor)
+        return _pool
+
+def getEngine():
+    '''
+    Get the process-wide SQLAlchemy engine, creating it on first use
+    '''
+    # SQLAlchemy is only installed in the containers that read data frames through it
+    from sqlalchemy import create_engine
+
+    global _engine
+    with _lock:
+        _reset()
+        if _engine is None:
+            _engine = create_engine(
+                f'postgresql+psycopg2://{dbconfig.USER}:{dbconfig.PASSWORD}@{dbconfig.HOST}/{dbconfig.DBNAME}',
+                pool_size=POOL_MAX, max_overflow=0, pool_recycle=3600, pool_pre_ping=True,
+                connect_args={"cursor_factory": CountingCursor})
+        return _engine
+
+def connect():
+    '''
+    Open a dedicated connection outside of the pool, for session state such as LISTEN
+    The caller is responsible for closing it
+    '''
+    return psycopg2.connect(DSN, cursor_factory=CountingCursor)
+
+def _record(start):
+    '''
+    Record the latency of one connection acquire
+    '''
+    elapsed = time.perf_counter() - start
+    with _lock:
+        _metrics["acquires"] += 1
+        _metrics["totalSeconds"] += elapsed
+        _metrics["maxSeconds"] = max(_metrics["maxSeconds"], elapsed)
+
+@contextmanager
+def connection():
+    '''
+    Borrow a psycopg2 connection from the pool and give it back when done
+    Waits for a free connection when all of them are in use
+    '''
+    pool = getPool()
+    start = time.perf_counter()
+    _slots.acquire()
+    try:
+        conn = pool.getconn()
+    except:
+        _slots.release()
+        raise
+    _record(start)
+
+    try:
+        yield conn
+    finally:
+        # Any open transaction is rolled back by the pool
+        pool.putconn(conn)
+        _slots.release()
+
+@contextmanager
+def engineConnection():
+    '''
+    Borrow a SQLAlchemy connection from the engine pool and give it back when done
+    '''
+    engine = getEngine()
+    start = time.perf_counter()
+    conn = engine.connect()
+    _record(start)
+
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+def getMetrics():
+    '''
+    Get the connection acquire metrics of the current process
+    '''
+    with _lock:
+        metrics = dict(_metrics)
+    metrics["avgSeconds"] = metrics["totalSeconds"] / metrics["acquires"] if metrics["acquires"] else 0.0
+    return metrics
@@ -1,50 +1,233 @@
-import psycopg2
-import dbconfig
+import dbpool
 from datetime import datetime
+import select
 import time
+import os
+
+# Channel notified every time a status is logged
+CHANNEL = 'status'
+
+# Process logging each status, and the statuses completing a run of that process
+PROCESSES = {1: 'etl', 2: 'etl', 3: 'ml', 4: 'ml'}
+COMPLETED = (2, 4)
+
+# Number of days status rows are kept before being rolled up into run summaries
+STATUS_RETENTION_DAYS = int(os.environ.get('STATUS_RETENTION_DAYS', 7))
+
+def createTable():
+    '''
+    Create the tables storing the process status
+        - status table with every status logged, kept for STATUS_RETENTION_DAYS days
+        - current_state table with one row per process, updated in place and used for coordination
+        - status_run table with one summary row per run whose statuses were removed from the status table
+    '''
+    sql = """
+        create table IF NOT EXISTS status (id SERIAL primary key, status int, message varchar(40), timestamp timestamp, lastloaded date );
+        create index IF NOT EXISTS status_lastloaded on status (lastloaded);
+        create table IF NOT EXISTS status_run (id SERIAL primary key, process varchar(20), started timestamp, finished timestamp,
+            status int, message varchar(40), lastloaded date, statuses int, firstid int, lastid int );
+        create index IF NOT EXISTS status_run_finished on status_run (finished);
+        """
+
+    # Create the current state of each process, filled from the statuses logged before it existed
+    stateSql = """
+        create table current_state (process varchar(20) primary key, statusid int, status int, message varchar(40),
+            timestamp timestamp, lastloaded date, completedid int );
+        insert into current_state (process, statusid, status, message, timestamp, lastloaded, completedid)
+            select distinct on (process) process, id, status, message, timestamp,
+                max(lastloaded) over (partition by process), max(id) filter (where status in (2, 4)) over (partition by process)
+            from (select *, case when status in (3, 4) then 'ml' else 'etl' end as process from status) s
+            order by process, id desc;
+        """
+
+    # Borrow a pooled connection to the database
+    with dbpool.connection() as connection:
+        mycursor = connection.cursor()
+
+        # Execute the SQL statement + commit or rollback
+        try:
+            # Add the primary key of a status table created before it had one
+            mycursor.execute("select to_regclass('status');")
+            if mycursor.fetchone()[0] is not None:
+                mycursor.execute("select to_regclass('status_pkey');")
+                if mycursor.fetchone()[0] is None:
+                    mycursor.execute("alter table status add primary key (id);")
+
+            mycursor.execute(sql)
+            mycursor.execute("select to_regclass('current_state');")
+            if mycursor.fetchone()[0] is None:
+                mycursor.execute(stateSql)
+            connection.commit()
+        except:
+            connection.rollback()
 
 def logStatus(status, message, lastLoaded=""):
     '''
     Log status information about the current process
+    The status is added to the status table and replaces the current state of the process in the same statement
     '''
     # Get time now
     now = datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')
 
-    # Open connection to the database
-    connection = psycopg2.connect(f"host='{dbconfig.HOST}' dbname='{dbconfig.DBNAME}' user='{dbconfig.USER}' password='{dbconfig.PASSWORD}'")
-    mycursor = connection.cursor()
-    
-    # Insert status info to the database
-    if lastLoaded != "":
-        sql = f"INSERT INTO status (status, message, timestamp, lastloaded) VALUES ('{status}', '{message}', '{now}', '{lastLoaded}');"
-    else: # if no data was loaded, lastLoaded is not added to the database
-        sql = f"INSERT INTO status (status, message, timestamp) VALUES ('{status}', '{message}', '{now}');"
-    
-    # Execute the SQL statement + commit or rollback
-    try:
-        mycursor.execute(sql)
-        connection.commit()
-    except:
-        connection.rollback()
+    # If no data was loaded, lastLoaded is not added to the database
+    if lastLoaded == "":
+        lastLoaded = None
+
+    # Insert status info to the database and update the current state, keeping the latest date loaded
+    sql = """
+        with logged as (
+            insert into status (status, message, timestamp, lastloaded) values (%(status)s, %(message)s, %(now)s, %(lastLoaded)s)
+                returning id, status, message, timestamp, lastloaded)
+        insert into current_state (process, statusid, status, message, timestamp, lastloaded, completedid)
+            select %(process)s, id, status, message, timestamp, lastloaded, case when %(completed)s then id end from logged
+        on conflict (process) do update
+            set statusid = excluded.statusid, status = excluded.status, message = excluded.message, timestamp = excluded.timestamp,
+                lastloaded = greatest(current_state.lastloaded, excluded.lastloaded),
+                completedid = coalesce(excluded.completedid, current_state.completedid);
+        """
+
+    # Wake up processes waiting on a status, once the insert is committed
+    sql = sql + f" NOTIFY {CHANNEL}, '{status}';"
+    parameters = {"status": status, "message": message, "now": now, "lastLoaded": lastLoaded,
+        "process": PROCESSES[status], "completed": status in COMPLETED}
     
-    # Close connection
-    connection.close()
+    # Borrow a pooled connection to the database
+    with dbpool.connection() as connection:
+        mycursor = connection.cursor()
+
+        # Execute the SQL statement + commit or rollback
+        try:
+            mycursor.execute(sql, parameters)
+            connection.commit()
+        except:
+            connection.rollback()
+
+def getLastDateLoaded():
+    '''
+    Get the latest date loaded by the ETL process, or None if nothing was loaded yet
+    '''
+    # Borrow a pooled connection to the database
+    with dbpool.connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("select lastloaded from current_state where process = 'etl';")
+        row = cursor.fetchone()
+
+    return row[0] if row else None
+
+def resetLastLoaded(lastLoaded):
+    '''
+    Move the latest date loaded by the ETL process back, so its next run loads the months after it again
+    Logged statuses only ever move it forward
+    '''
+    # Borrow a pooled connection to the database
+    with dbpool.connection() as connection:
+        mycursor = connection.cursor()
+
+        # Execute the SQL statement + commit or rollback
+        try:
+            mycursor.execute("update current_state set lastloaded = %s where process = 'etl';", (lastLoaded,))
+            connection.commit()
+        except:
+            connection.rollback()
+            raise
+
+def compactStatus(days=STATUS_RETENTION_DAYS):
+    '''
+    Roll the statuses of runs completed more than the given days ago up into one status_run row per run and remove them
+        - a run is the sequence of statuses of a process ending with a completed status
+        - runs still in progress are kept, whatever their age
+    Returns the number of runs rolled up
+    '''
+    sql = """
+        with numbered as (
+            select id, status, message, timestamp, lastloaded, process, completed,
+                coalesce(sum(completed) over (partition by process order by id rows between unbounded preceding and 1 preceding), 0) as run
+            from (select *, case when status in (3, 4) then 'ml' else 'etl' end as process, cast(status in (2, 4) as int) as completed
+                from status) s),
+        runs as (
+            select process, run, min(id) as firstid, max(id) as lastid, min(timestamp) as started, max(timestamp) as finished,
+                count(*) as statuses, max(lastloaded) as lastloaded
+            from numbered
+            group by process, run
+            having bool_or(completed = 1) and max(timestamp) < now() - make_interval(days => %s)),
+        summaries as (
+            insert into status_run (process, started, finished, status, message, lastloaded, statuses, firstid, lastid)
+                select r.process, r.started, r.finished, s.status, s.message, r.lastloaded, r.statuses, r.firstid, r.lastid
+                from runs r join status s on s.id = r.lastid)
+        delete from status where id in (select n.id from numbered n join runs r on r.process = n.process and r.run = n.run)
+            returning (select count(*) from runs);
+        """
+
+    # Borrow a pooled connection to the database
+    with dbpool.connection() as connection:
+        mycursor = connection.cursor()
+
+        # Execute the SQL statement + commit or rollback
+        try:
+            mycursor.execute(sql, (days,))
+            row = mycursor.fetchone()
+            connection.commit()
+        except:
+            connection.rollback()
+            raise
+
+    return row[0] if row else 0
 
 def checkStatus(criteria):
     ''''
     Get last status logged
+    Reads the current state of the processes rather than the status history
     '''
-    # Open connection to the database
-    connection = psycopg2.connect(f"host='{dbconfig.HOST}' dbname='{dbconfig.DBNAME}' user='{dbconfig.USER}' password='{dbconfig.PASSWORD}'")
-    cursor = connection.cursor()
+    # Borrow a pooled connection to the database
+    with dbpool.connection() as connection:
+        cursor = connection.cursor()
     
-    # Get the date of the last row loaded
-    cursor.execute("select status from status order by id desc limit 1;")
-    lastStatus = cursor.fetchone()[0]
-    connection.close()
+        # Get the status logged last by any process
+        cursor.execute("select status from current_state order by statusid desc limit 1;")
+        row = cursor.fetchone()
+        lastStatus = row[0] if row else None
     
     # If it's the first run, set an initial date
     if lastStatus == criteria:
         return False
     else:
-        return True
\ No newline at end of file
+        return True
+
+def waitForStatus(criteria, pollSeconds=60):
+    '''
+    Block until the last status logged matches the criteria
+    Wakes up on the status channel notification and falls back to polling when the channel is unavailable
+    '''
+    # Listen before checking the status, so a status logged in between is not missed
+    listener = None
+    try:
+        listener = dbpool.connect()
+        listener.autocommit = True
+        listener.cursor().execute(f"LISTEN {CHANNEL};")
+    except:
+        print("Status channel unavailable, polling instead")
+        if listener is not None:
+            listener.close()
+        listener = None
+
+    try:
+        while checkStatus(criteria):
+            print("Waiting for status...")
+
+            # Without a listener, check again after the poll interval
+            if listener is None:
+                time.sleep(pollSeconds)
+                continue
+
+            # Wait for a notification, checking again at least every poll interval
+            try:
+                if select.select([listener], [], [], pollSeconds) != ([], [], []):
+                    listener.poll()
+                    listener.notifies.clear()
+            except:
+                print("Status channel lost, polling instead")
+                listener.close()
+                listener = None
+    finally:
+        if listener is not None:
+            listener.close()
\ No newline at end of file
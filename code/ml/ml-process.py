@@ -1,89 +1,180 @@
 from datetime import timedelta, datetime
-import time
 from prefect import task, Flow
 from prefect.schedules import IntervalSchedule
 from prefect.executors import LocalDaskExecutor
-import psycopg2
 import pandas
-from sklearn.cluster import KMeans
-import dbconfig
-from sqlalchemy import create_engine
+import numpy
+import joblib
+from sklearn.cluster import KMeans, MiniBatchKMeans
+import dbpool
+import dbmetrics
 import dbstatus
+import io
 import os
 
+# Model settings
+# - ML_MODEL_MODE: 'full' refits from scratch, 'warm' refits starting from the previous centroids,
+#   'minibatch' updates the previous centroids with the new or changed rows only
+# - ML_MODEL_DIR: directory where the fitted model versions are kept between runs
+ML_MODEL_MODE = os.environ.get('ML_MODEL_MODE', 'full')
+ML_MODEL_DIR = os.environ.get('ML_MODEL_DIR', 'ml/model')
+
+# Temperature levels from the coldest to the hottest cluster, one per cluster
+TEMP_LEVELS = ['Very Low','Low','Medium','High','Very High']
+N_CLUSTERS = len(TEMP_LEVELS)
+
+# Number of model versions kept on disk
+MODEL_VERSIONS_KEPT = 5
+
+# Columns identifying one city and quarter
+CITY_QUARTER_KEYS = ["city_id", "quarter"]
+
 @task(max_retries=3, retry_delay=timedelta(seconds=1))
+@dbmetrics.measure("ml")
 def createTable():
     '''
     Create the tables required by the ML process
-        - temperature_level to store cluster results
+        - temperature_level to store cluster results by city id, joined to the city names only when shown
+        - status tables used to wait for the ETL process, if the ETL didn't create them yet
     '''
-    # Open connection to the database
-    connection = psycopg2.connect(f"host='{dbconfig.HOST}' dbname='{dbconfig.DBNAME}' user='{dbconfig.USER}' password='{dbconfig.PASSWORD}'")
-    mycursor = connection.cursor()
-    
-    # Create table to store the temperature level data and delete any previous data
+    # Create table to store the temperature level data
+    # Previous data is kept until the load task swaps in the new results
     sql = """
-        create table IF NOT EXISTS temperature_level (region varchar(50), country varchar(30), city varchar(50), quarter int, avgtemp decimal, templevel varchar(10));
-        delete from temperature_level;
+        create table IF NOT EXISTS temperature_level (city_id int, quarter smallint, avgtemp real, templevel varchar(10));
         """
     
-    # Execute the SQL statement + commit or rollback
-    try:
-        mycursor.execute(sql)
-        connection.commit()
-    except:
-        connection.rollback()
-    
-    # Close connection
-    connection.close()
+    # Borrow a pooled connection to the database
+    with dbpool.connection() as connection:
+        mycursor = connection.cursor()
+
+        # Execute the SQL statement + commit or rollback
+        try:
+            # Results stored with the city names or small integer city ids are dropped, they are replaced by the next run
+            mycursor.execute("""select attname from pg_attribute where attrelid = to_regclass('temperature_level')
+                and (attname = 'region' or (attname = 'city_id' and atttypid = 'smallint'::regtype));""")
+            if mycursor.fetchone() is not None:
+                mycursor.execute("drop table temperature_level;")
+
+            mycursor.execute(sql)
+            connection.commit()
+        except:
+            connection.rollback()
+
+    # Create the status tables
+    dbstatus.createTable()
     
 @task(max_retries=3, retry_delay=timedelta(seconds=1))
+@dbmetrics.measure("ml")
 def extract():
     '''
     Extract data from temperatures table created by the ETL process
     '''
-    # Wait for ETL process to complete
-    while (dbstatus.checkStatus(2)):
-        print("Waiting for ETL to finish...")
-        time.sleep(60)
+    # Wait for ETL process to complete, woken up as soon as it logs its final status
+    print("Waiting for ETL to finish...")
+    dbstatus.waitForStatus(2)
 
     # Log status message
     dbstatus.logStatus(3, "ML 1/2 - Process started")
 
-    # Open connection to the database
-    alchemyEngine = create_engine(f'postgresql+psycopg2://{dbconfig.USER}:{dbconfig.PASSWORD}@{dbconfig.HOST}/{dbconfig.DBNAME}', pool_recycle=3600);
-    connection = alchemyEngine.connect();
-   
     # Get the average temperature for each city per quarter
-    sql = """select region, country, city, quarter , round( avg(avgtemp),2) as avgtemp
-    from temperatures
-    group by region, country, city , quarter 
-    order by region, country, city, quarter ;
+    # The running sums are maintained by the ETL process for every row it loads
+    sql = """select city_id, quarter , round( sumtemp / counttemp,2) as avgtemp
+    from temperature_quarter
+    order by city_id, quarter ;
     """
-    data = pandas.read_sql_query(sql,con=connection)
-    
-    # Close database connection
-    connection.close()
+
+    # Borrow a pooled connection to the database
+    with dbpool.engineConnection() as connection:
+        data = pandas.read_sql_query(sql,con=connection)
 
     # Return queried data
     return data
 
+def loadModel():
+    '''
+    Load the latest model version saved on disk
+    Returns the version number and a dictionary with the model and the data it was fitted on
+    '''
+    try:
+        with open(os.path.join(ML_MODEL_DIR, "latest")) as latest:
+            version = int(latest.read())
+        return version, joblib.load(os.path.join(ML_MODEL_DIR, f"model-{version}.joblib"))
+    except (OSError, ValueError):
+        return 0, None
+
+def saveModel(version, model, data):
+    '''
+    Save a new model version on disk and point to it as the latest one
+    '''
+    os.makedirs(ML_MODEL_DIR, exist_ok=True)
+
+    # Write the model under a temporary name first, so a failed write never becomes the latest version
+    path = os.path.join(ML_MODEL_DIR, f"model-{version}.joblib")
+    joblib.dump({"model": model, "data": data}, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+    with open(os.path.join(ML_MODEL_DIR, "latest.tmp"), "w") as latest:
+        latest.write(str(version))
+    os.replace(os.path.join(ML_MODEL_DIR, "latest.tmp"), os.path.join(ML_MODEL_DIR, "latest"))
+
+    # Remove old versions
+    old = os.path.join(ML_MODEL_DIR, f"model-{version - MODEL_VERSIONS_KEPT}.joblib")
+    if os.path.exists(old):
+        os.remove(old)
+
+def getChangedRows(data, previous):
+    '''
+    Get the rows that are new or whose average temperature changed since the previous model was fitted
+    All rows are returned when the previous data was identified by other columns
+    '''
+    if not set(CITY_QUARTER_KEYS).issubset(previous.columns):
+        return data
+
+    merged = data.merge(previous, on=CITY_QUARTER_KEYS, how="left", suffixes=("", "_previous"))
+    return data[(merged["avgtemp"] != merged["avgtemp_previous"]).values]
+
 @task
+@dbmetrics.measure("ml")
 def createModel(data):
     '''
-    Run KMeans to clusterize the data into 5 categories based on their temperature per quarter
+    Run KMeans to clusterize the data into one category per temperature level based on their temperature per quarter
+    Depending on the model mode, the previous model version is used as a starting point
     '''
+    features = data.drop(columns=["city_id"])
+    version, previous = loadModel()
+
     # Set clusters based on temperature and quarter
-    model = KMeans(n_clusters=5, random_state=42).fit(data.drop(columns=["region","country","city"]))
-    clusters = model.labels_
+    if previous is None or ML_MODEL_MODE == 'full':
+        model = KMeans(n_clusters=N_CLUSTERS, random_state=42).fit(features)
+    elif ML_MODEL_MODE == 'warm':
+        # Refit starting from the previous centroids, which keeps cluster numbers stable
+        model = KMeans(n_clusters=N_CLUSTERS, init=previous["model"].cluster_centers_, n_init=1).fit(features)
+    elif ML_MODEL_MODE == 'minibatch':
+        model = previous["model"]
+        changed = getChangedRows(data, previous["data"])
+
+        # Continue from the previous centroids, seeding a mini-batch model when the previous one was a full fit
+        if not isinstance(model, MiniBatchKMeans):
+            model = MiniBatchKMeans(n_clusters=N_CLUSTERS, init=model.cluster_centers_, n_init=1, random_state=42)
+            changed = data
+
+        # Only update the centroids with new or changed rows
+        if not changed.empty:
+            model.partial_fit(changed.drop(columns=["city_id"]))
+    else:
+        raise ValueError(f"Unknown model mode: {ML_MODEL_MODE}")
 
     # Add clusters to the data frame as a new column
-    data["cluster"] = clusters
+    data["cluster"] = model.predict(features)
+
+    # Keep the model and the data it was fitted on for the next run
+    saveModel(version + 1, model, data[CITY_QUARTER_KEYS + ["avgtemp"]])
     
     # Return the data with the cluster information
     return data
 
 @task
+@dbmetrics.measure("ml")
 def transform(data):
     ''''
     Transform the clusterized data by 
@@ -91,26 +182,15 @@ def transform(data):
     - setting cluster names based on how low or high the average is
     '''
 
-    # Get average temperature per cluster
-    clusterMetadata = pandas.DataFrame({
-        "cluster": [0,1,2,3,4],
-        "avgtemp":
-            [data[data.cluster==0]["avgtemp"].mean(),
-            data[data.cluster==1]["avgtemp"].mean(),
-            data[data.cluster==2]["avgtemp"].mean(),
-            data[data.cluster==3]["avgtemp"].mean(),
-            data[data.cluster==4]["avgtemp"].mean()]
-            })
+    # Get average temperature per cluster, including clusters without any rows
+    clusterMetadata = data.groupby("cluster")["avgtemp"].mean().reindex(range(len(TEMP_LEVELS)))
 
     # Set temperature level for each cluster sorted by temperature
-    clusterMetadata = clusterMetadata.sort_values(by='avgtemp')
-    clusterMetadata['templevel'] = ['Very Low','Low','Medium','High','Very High']
-
-    # Add level to main table
-    def setTempLevel(cluster):
-        level = clusterMetadata[clusterMetadata.cluster == cluster]['templevel'].iloc[0]
-        return str(level)
-    data['templevel'] = data.apply(lambda x : setTempLevel(x['cluster']) , axis=1)
+    levels = numpy.empty(len(TEMP_LEVELS), dtype=object)
+    levels[clusterMetadata.sort_values().index] = TEMP_LEVELS
+
+    # Add level to main table by looking up each cluster number
+    data['templevel'] = levels[data['cluster'].values]
     
     # Remove cluster column
     data = data.drop(columns="cluster")
@@ -118,30 +198,40 @@ def transform(data):
     # Return transformed clusterized data
     return data
 
-@task
+@task(max_retries=3, retry_delay=timedelta(seconds=1))
+@dbmetrics.measure("ml")
 def load(data):
     ''''
     Task to load the processed data into the database
+    A failed load is rolled back and raised, keeping the previous results, so the task is retried instead of logged as completed
     '''
 
-    # Connect to the database
-    connection = psycopg2.connect(f"host='{dbconfig.HOST}' dbname='{dbconfig.DBNAME}' user='{dbconfig.USER}' password='{dbconfig.PASSWORD}'")
-    mycursor = connection.cursor()
+    # Serialize the results as CSV in memory
+    buffer = io.StringIO()
+    data.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
 
-    # Iterate through each row and insert to the database
-    for index, row in data.iterrows():
-        # Prepare SQL query to INSERT a record into the database.
-        sql = "INSERT INTO temperature_level (region, country, city, quarter, avgtemp, templevel) VALUES ('%s', '%s', '%s', '%s', '%s', '%s');" % (row[0], row[1], row[2], row[3], row[4], row[5])
+    # Bulk load the results into a staging table, then swap it in place of temperature_level
+    # Everything runs in one transaction, so readers see either the previous or the new results
+    with dbpool.connection() as connection:
+        mycursor = connection.cursor()
 
-        # Execute SQL statement + commit or rollback
+        # Execute SQL statements + commit or rollback
         try:
-            mycursor.execute(sql)
+            mycursor.execute("""
+                drop table IF EXISTS temperature_level_staging;
+                create table temperature_level_staging (like temperature_level including all);
+                """)
+            mycursor.copy_expert("COPY temperature_level_staging (city_id, quarter, avgtemp, templevel) FROM STDIN WITH (FORMAT csv)", buffer)
+            mycursor.execute("""
+                alter table temperature_level rename to temperature_level_old;
+                alter table temperature_level_staging rename to temperature_level;
+                drop table temperature_level_old;
+                """)
             connection.commit()
         except:
             connection.rollback()
-
-    # Close database connection
-    connection.close()
+            raise
 
     # Log status message
     dbstatus.logStatus(4, "ML 2/2 - Process completed")
@@ -167,7 +257,7 @@ def main():
 
     # Configure Prefect flow
     with Flow("ml", schedule=schedule) as flow:
-        createTable() # Create/Clean up database table
+        createTable() # Create database table - if not already created
         data = extract()
         data = createModel(data)
         data = transform(data)
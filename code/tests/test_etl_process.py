@@ -0,0 +1,50 @@
+import os
+import sys
+
+import pytest
+
+# Make the ETL, shared library and benchmark modules importable
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'etl'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'benchmark'))
+
+pandas = pytest.importorskip("pandas")
+pytest.importorskip("prefect")
+pytest.importorskip("psycopg2")
+pytest.importorskip("pyarrow")
+
+import etl_process
+import synthetic
+
+def test_aggregate_source_keeps_only_observed_months(tmp_path):
+    '''
+    Chunks sharing categories must not expand into every combination of region, country, city, year and month
+    '''
+    # The synthetic source cycles through the cities every day, so every chunk interleaves all of them
+    data = synthetic.sourceFrame(20000, cities=50)
+    path = tmp_path / "city_temperature.csv"
+    data.to_csv(path, index=False)
+
+    result = etl_process.aggregateSource(str(path), chunkSize=5000)
+
+    valid = data[data.AvgTemperature != -99]
+    expected = valid.groupby(etl_process.MONTH_KEYS)['AvgTemperature'].agg(['sum', 'count'])
+
+    assert len(result) == len(expected)
+    assert (result['count'] > 0).all()
+    assert result['count'].sum() == len(valid)
+
+def test_read_source_cache_keeps_names_as_categories(tmp_path, monkeypatch):
+    '''
+    The cached copy of a source part is read back with the same rows, its names as categories
+    '''
+    data = synthetic.sourceFrame(5000, cities=50)
+    path = tmp_path / "city_temperature.csv"
+    data.to_csv(path, index=False)
+    monkeypatch.setattr(etl_process, "ETL_CACHE_DIR", str(tmp_path / "cache"))
+
+    parsed = etl_process.readSource(str(path))
+    cached = etl_process.readSource(str(path))
+
+    assert all(isinstance(cached[column].dtype, pandas.CategoricalDtype) for column in etl_process.CATEGORY_COLUMNS)
+    pandas.testing.assert_frame_equal(cached, parsed)
@@ -0,0 +1,92 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import psycopg2
+import json
+import dbpool
+import os
+
+# Port the data service listens on, nginx proxies /api/ to it
+PORT = int(os.environ.get('DATA_SERVICE_PORT', 8081))
+
+# Default and maximum number of rows per page
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Columns returned for the temperatures table, the date and city id of the last row being the key of the next page
+COLUMNS = ["region", "country", "city", "quarter", "date", "avgtemp", "city_id"]
+
+# Supported filters and their SQL condition
+FILTERS = {
+    "region": "c.region = %s",
+    "country": "c.country = %s",
+    "city": "c.city = %s",
+    "from": "t.date >= %s",
+    "to": "t.date <= %s",
+}
+
+def getTemperatures(query):
+    '''
+    Get one page of the temperatures table, optionally filtered
+    Pages are read by keyset: the next page starts after the date and city id of the last row, given as after=<date>,<city id>
+    Returns the data as a dictionary of columns
+    '''
+    # Build the filter conditions from the query parameters
+    conditions = [FILTERS[name] for name in FILTERS if query.get(name)]
+    values = [query[name] for name in FILTERS if query.get(name)]
+
+    # Start the page after the given row, found through the index on date and city id however deep the page is
+    if query.get("after"):
+        date, cityId = query["after"].split(",")
+        conditions.append("(t.date, t.city_id) > (%s, %s)")
+        values += [date, int(cityId)]
+    where = "where " + " and ".join(conditions) if conditions else ""
+
+    # Get page size
+    size = min(max(int(query.get("size", PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+
+    # Temperatures are stored by city id, the city names are joined for the returned page only
+    # The real temperature is rounded before widening to float, so the JSON output has no binary noise
+    sql = f"""select c.region, c.country, c.city, t.quarter, cast(t.date as text), cast(round(cast(t.avgtemp as numeric), 2) as float), t.city_id
+        from temperatures t join city c on c.id = t.city_id {where}
+        order by t.date, t.city_id limit %s;"""
+
+    # Borrow a pooled connection to the database
+    with dbpool.connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute(sql, values + [size])
+        rows = cursor.fetchall()
+
+    return {column: [row[index] for row in rows] for index, column in enumerate(COLUMNS)}
+
+class DataHandler(BaseHTTPRequestHandler):
+    '''
+    Serve table data as JSON for the result pages
+    '''
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != "/api/temperatures":
+            self.send_error(404)
+            return
+
+        # Invalid numbers or dates in the query are reported as bad requests
+        try:
+            data = getTemperatures({name: values[0] for name, values in parse_qs(url.query).items()})
+        except (ValueError, psycopg2.DataError):
+            self.send_error(400)
+            return
+
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def main():
+    '''
+    Start the data service
+    '''
+    ThreadingHTTPServer(("127.0.0.1", PORT), DataHandler).serve_forever()
+
+if __name__ == "__main__":
+    main()
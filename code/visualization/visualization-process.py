@@ -1,29 +1,118 @@
 import pandas
-from sqlalchemy import create_engine
-from bokeh.plotting import output_file, show
-from bokeh.io import show
-from bokeh.models import ColumnDataSource, DataTable, TableColumn
-import dbconfig
+from bokeh.plotting import figure
+from bokeh.embed import file_html
+from bokeh.resources import CDN
+from bokeh.layouts import column, row
+from bokeh.palettes import Category20
+from bokeh.models import AjaxDataSource, Button, ColumnDataSource, CustomJS, DataTable, Spinner, TableColumn, TextInput
+import dbpool
+import dbmetrics
+import dbstatus
 from datetime import timedelta, datetime
 from prefect import task, Flow
 from prefect.schedules import IntervalSchedule
 from prefect.executors import LocalDaskExecutor
+import tempfile
+import gzip
+import os
+
+# Brotli is optional, without it the pages are only precompressed with gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Number of rows per page requested by the ETL result page
+ETL_PAGE_SIZE = 100
+
+# Number of days of task durations shown on the status page
+METRICS_DAYS = 7
+
+# Number of run summaries shown on the status page
+STATUS_RUNS = 200
+
+# Directory the pages are written to, served by Nginx
+PAGES_DIR = "pages"
+
+# Fingerprint of the data each page was last rendered with
+renderedFingerprints = {}
 
 @task(max_retries=3, retry_delay=timedelta(seconds=1))
-def getMLResult(status):
+@dbmetrics.measure("visualization")
+def getFingerprints():
+    ''''
+    Get a cheap fingerprint of the data shown on each page from the current state of the processes
+        - status page changes with every status logged
+        - ETL and trends pages change when the ETL logs a completed load (status 2)
+        - ML page changes when the ML process logs a completed load (status 4)
+    '''
+    sql = "select max(statusid), max(completedid) filter (where process = 'etl'), max(completedid) filter (where process = 'ml') from current_state;"
+
+    # Borrow a pooled connection to the database
+    with dbpool.connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute(sql)
+        status, etl, ml = cursor.fetchone()
+
+    return {"status": status, "etl": etl, "trends": etl, "ml": ml}
+
+def replaceFile(path, content):
+    '''
+    Write content to a temporary file and rename it in place, so Nginx never serves a half-written file
+    '''
+    handle, temporaryPath = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(handle, "wb") as file:
+            file.write(content)
+        os.chmod(temporaryPath, 0o644)
+        os.replace(temporaryPath, path)
+    except:
+        os.remove(temporaryPath)
+        raise
+
+def writeCompressed(path, content):
+    '''
+    Write the precompressed .gz and .br siblings of a page, served by Nginx instead of compressing it on every request
+    '''
+    replaceFile(f"{path}.gz", gzip.compress(content, compresslevel=9, mtime=0))
+    if brotli is not None:
+        replaceFile(f"{path}.br", brotli.compress(content, mode=brotli.MODE_TEXT))
+
+def writePage(name, layout, title):
+    '''
+    Render a page and replace the previous version and its compressed siblings
+    The page is rendered to a string, as Bokeh's output_file/show state is shared by all threads
+    The compressed siblings are written first, so they are never older than the page
+    '''
+    path = os.path.join(PAGES_DIR, f"{name}.html")
+    content = file_html(layout, CDN, title).encode("utf-8")
+    writeCompressed(path, content)
+    replaceFile(path, content)
+
+def isRendered(page, fingerprints):
+    '''
+    Check whether a page was already rendered with the current data
+    '''
+    return page in renderedFingerprints and renderedFingerprints[page] == fingerprints[page]
+
+@task(max_retries=3, retry_delay=timedelta(seconds=1))
+@dbmetrics.measure("visualization")
+def getMLResult(fingerprints):
     ''''
     Get table generated by the ML process from the database
     '''
-    # Open connection to the database
-    alchemyEngine = create_engine(f'postgresql+psycopg2://{dbconfig.USER}:{dbconfig.PASSWORD}@{dbconfig.HOST}/{dbconfig.DBNAME}', pool_recycle=3600);
-    connection = alchemyEngine.connect();
-    
-    # Get temperature_level table
-    sql = """select * from temperature_level ;"""
-    data = pandas.read_sql_query(sql,con=connection)
+    # Skip if the page already shows the current data
+    if isRendered("ml", fingerprints):
+        return "Done"
+
+    # Get temperature_level table, with the names of the cities
+    sql = """select c.region, c.country, c.city, l.quarter, l.avgtemp, l.templevel
+        from temperature_level l join city c on c.id = l.city_id
+        order by c.region, c.country, c.city, l.quarter ;"""
 
-    # Close database connection
-    connection.close()
+    # Borrow a pooled connection to the database
+    with dbpool.engineConnection() as connection:
+        data = pandas.read_sql_query(sql,con=connection)
 
     # Skip if no data on data frame
     if data.empty:
@@ -42,33 +131,25 @@ def getMLResult(status):
     data_table = DataTable(source=source, columns=columns, width=800, height=800)
 
     # Output file with results
-    output_file("pages/mlresult.html")
-    show(data_table)
+    writePage("mlresult", data_table, "ML Result")
+    renderedFingerprints["ml"] = fingerprints["ml"]
 
-    return status
+    return "Done"
 
 @task(max_retries=3, retry_delay=timedelta(seconds=1))
-def getETLResult(status):
+@dbmetrics.measure("visualization")
+def getETLResult(fingerprints):
     ''''
-    Get table generated by the ETL process from the database
-    '''
-    # Open connection to the database
-    alchemyEngine = create_engine(f'postgresql+psycopg2://{dbconfig.USER}:{dbconfig.PASSWORD}@{dbconfig.HOST}/{dbconfig.DBNAME}', pool_recycle=3600);
-    connection = alchemyEngine.connect();
-    
-    # Get temperatures table
-    sql = "select region, country, city, quarter, cast(date as text), avgtemp from temperatures;"
-    data = pandas.read_sql_query(sql,con=connection)
-
-    # Close database connection
-    connection.close()
-    
-    # Skip if no data on data frame
-    if data.empty:
+    Create the page for the table generated by the ETL process
+    The page doesn't embed the data, it fetches it a page at a time from the data service
+    '''
+    # Skip if the page already shows the current data
+    if isRendered("etl", fingerprints):
         return "Done"
 
-    # Configure table to visualize
-    source = ColumnDataSource(data)
+    # Configure table to visualize, filled a page at a time by the data service
+    source = AjaxDataSource(data_url=f"/api/temperatures?size={ETL_PAGE_SIZE}", method="GET", polling_interval=None, mode="replace")
+    source.data = {"region": [], "country": [], "city": [], "quarter": [], "date": [], "avgtemp": [], "city_id": []}
     columns = [
             TableColumn(field="region", title="Region"),
             TableColumn(field="country", title="Country"),
@@ -79,27 +160,130 @@ def getETLResult(status):
         ]
     data_table = DataTable(source=source, columns=columns, width=800, height=800)
 
+    # Configure filters and page navigation
+    filters = {
+        "region": TextInput(title="Region"),
+        "country": TextInput(title="Country"),
+        "city": TextInput(title="City"),
+        "from": TextInput(title="From (YYYY-MM-DD)"),
+        "to": TextInput(title="To (YYYY-MM-DD)"),
+    }
+
+    # The page tags keep the key each visited page starts after, so Previous fetches the same rows again
+    page = Spinner(title="Page", low=1, step=1, value=1, width=100, disabled=True, tags=[None])
+    previousPage = Button(label="Previous")
+    nextPage = Button(label="Next")
+
+    # Fetch the current page from the data service, starting after the date and city id kept for it
+    # Next keeps the key of the last row shown, a filter change goes back to the first page
+    fetch = """
+        const params = new URLSearchParams({size: size})
+        if (page.tags[page.value - 1]) params.set("after", page.tags[page.value - 1])
+        for (const [name, input] of Object.entries(filters)) {
+            if (input.value) params.set(name, input.value)
+        }
+        source.data_url = "/api/temperatures?" + params.toString()
+        source.get_data("replace")
+    """
+    fetchArgs = dict(source=source, page=page, filters=filters, size=ETL_PAGE_SIZE)
+    for textInput in filters.values():
+        textInput.js_on_change("value", CustomJS(args=fetchArgs, code="page.tags = [null]\npage.value = 1\n" + fetch))
+    previousPage.js_on_click(CustomJS(args=fetchArgs, code="if (page.value <= 1) return\npage.value = page.value - 1\n" + fetch))
+    nextPage.js_on_click(CustomJS(args=fetchArgs, code="""
+        const rows = source.data.date.length
+        if (rows < size) return
+        page.tags = page.tags.slice(0, page.value).concat([source.data.date[rows - 1] + "," + source.data.city_id[rows - 1]])
+        page.value = page.value + 1
+        """ + fetch))
+
+    layout = column(row(*filters.values()), data_table, row(previousPage, page, nextPage))
+
     # Output file with results
-    output_file("pages/etlresult.html")
-    show(data_table)
+    writePage("etlresult", layout, "ETL Result")
+    renderedFingerprints["etl"] = fingerprints["etl"]
 
-    return status
+    return "Done"
 
 @task(max_retries=3, retry_delay=timedelta(seconds=1))
-def getStatus():
+@dbmetrics.measure("visualization")
+def getTrends(fingerprints):
+    ''''
+    Create the page with the temperature trend of each region and of the countries in each region
+    Reads the rollups maintained by the ETL process instead of the temperatures table
+    '''
+    # Skip if the page already shows the current data
+    if isRendered("trends", fingerprints):
+        return "Done"
+
+    # Get monthly averages by region and yearly averages by country
+    regionSql = """select region, date, round(sum(sumtemp) / sum(counttemp), 2) as avgtemp from temperature_region_month
+        group by region, date order by region, date;"""
+    countrySql = """select region, country, cast(extract(year from date) as int) as year, round(sum(sumtemp) / sum(counttemp), 2) as avgtemp
+        from temperature_country_month group by region, country, year order by region, country, year;"""
+
+    # Borrow a pooled connection to the database
+    with dbpool.engineConnection() as connection:
+        regions = pandas.read_sql_query(regionSql,con=connection)
+        countries = pandas.read_sql_query(countrySql,con=connection)
+
+    # Skip if no data on data frame
+    if regions.empty:
+        return "Done"
+
+    # Configure chart with the monthly trend of each region
+    regionChart = figure(title="Monthly temperature by region (°C)", x_axis_type="datetime", width=800, height=400)
+    for index, (region, regionData) in enumerate(regions.groupby("region")):
+        regionChart.line(x="date", y="avgtemp", source=ColumnDataSource(regionData), color=Category20[20][index % 20], legend_label=region)
+    regionChart.legend.click_policy = "hide"
+
+    # Configure one chart per region with the yearly trend of its countries
+    charts = [regionChart]
+    for region, regionData in countries.groupby("region"):
+        chart = figure(title=f"Yearly temperature in {region} (°C)", width=800, height=400)
+        for index, (country, countryData) in enumerate(regionData.groupby("country")):
+            chart.line(x="year", y="avgtemp", source=ColumnDataSource(countryData), color=Category20[20][index % 20], legend_label=country)
+        chart.legend.click_policy = "hide"
+        chart.legend.label_text_font_size = "8pt"
+        charts.append(chart)
+
+    # Output file with results
+    writePage("trends", column(*charts), "Temperature Trends")
+    renderedFingerprints["trends"] = fingerprints["trends"]
+
+    return "Done"
+
+@task(max_retries=3, retry_delay=timedelta(seconds=1))
+@dbmetrics.measure("visualization")
+def getStatus(fingerprints):
     ''''
     Get table generated with status information from the database
     '''
-    # Open connection to the database
-    alchemyEngine = create_engine(f'postgresql+psycopg2://{dbconfig.USER}:{dbconfig.PASSWORD}@{dbconfig.HOST}/{dbconfig.DBNAME}', pool_recycle=3600);
-    connection = alchemyEngine.connect();
-    
-    # Get status table
-    sql = "select id, status, message, cast(timestamp as text), cast(lastloaded as text) from status;"
-    data = pandas.read_sql_query(sql,con=connection)
+    # Skip if the page already shows the current data
+    if isRendered("status", fingerprints):
+        return "Done"
 
-    # Close database connection
-    connection.close()
+    # Get the statuses kept in the status table and the summaries of older runs, latest first
+    sql = "select id, status, message, cast(timestamp as text), cast(lastloaded as text) from status order by id desc;"
+    runsSql = f"""select process, cast(started as text), cast(finished as text), message, cast(lastloaded as text), statuses
+        from status_run order by id desc limit {STATUS_RUNS};"""
+
+    # Get task durations of the last days
+    metricsSql = f"""select flow || '.' || task as stage, started, wallseconds from task_metrics
+        where started > now() - interval '{METRICS_DAYS} days' order by started;"""
+
+    # Borrow a pooled connection to the database
+    with dbpool.engineConnection() as connection:
+        data = pandas.read_sql_query(sql,con=connection)
+        runs = pandas.read_sql_query(runsSql,con=connection)
+        metrics = pandas.read_sql_query(metricsSql,con=connection)
+
+    # Configure chart with the duration trend of each stage
+    chart = figure(title="Task duration (seconds)", x_axis_type="datetime", width=800, height=400)
+    for index, (stage, stageMetrics) in enumerate(metrics.groupby("stage")):
+        color = Category20[20][index % 20]
+        chart.line(x="started", y="wallseconds", source=ColumnDataSource(stageMetrics), color=color, legend_label=stage)
+        chart.circle(x="started", y="wallseconds", source=ColumnDataSource(stageMetrics), color=color, legend_label=stage)
+    chart.legend.click_policy = "hide"
 
     # Configure table to visualize
     source = ColumnDataSource(data)
@@ -112,11 +296,31 @@ def getStatus():
         ]
     data_table = DataTable(source=source, columns=columns, width=800, height=800)
 
+    # Configure table with the summaries of older runs
+    runColumns = [
+            TableColumn(field="process", title="Process"),
+            TableColumn(field="started", title="Started"),
+            TableColumn(field="finished", title="Finished"),
+            TableColumn(field="message", title="Last Message"),
+            TableColumn(field="lastloaded", title="Last Date Loaded"),
+            TableColumn(field="statuses", title="Statuses"),
+        ]
+    runs_table = DataTable(source=ColumnDataSource(runs), columns=runColumns, width=800, height=400)
+
     # Output file with results
-    output_file("pages/status.html")
-    show(data_table)
+    writePage("status", column(data_table, runs_table, chart), "Status")
+    renderedFingerprints["status"] = fingerprints["status"]
 
-    return "Done!"
+    return "Done"
+
+def createTable():
+    '''
+    Create the tables read by the visualization process, if the other processes didn't create them yet
+        - status tables (see dbstatus.createTable)
+        - task_metrics table (see dbmetrics.createTable)
+    '''
+    dbstatus.createTable()
+    dbmetrics.createTable()
 
 def main():
     ''''
@@ -129,14 +333,24 @@ def main():
     )
 
     # Configure Prefect flow
+    # The pages don't depend on each other, so they are rendered concurrently once the fingerprints are read
     with Flow("visualization", schedule=schedule) as flow:
-        result = getStatus()
-        result = getETLResult(result)
-        result = getMLResult(result)
-        print(result)
+        fingerprints = getFingerprints()
+        getStatus(fingerprints)
+        getETLResult(fingerprints)
+        getTrends(fingerprints)
+        getMLResult(fingerprints)
+
+    # Create database tables - if not already created
+    createTable()
+
+    # Compress the static home page once, the other pages are compressed when rendered
+    path = os.path.join(PAGES_DIR, "index.html")
+    with open(path, "rb") as file:
+        writeCompressed(path, file.read())
 
-    # Execute ETL flow
-    flow.run(executor=LocalDaskExecutor())
+    # Execute visualization flow, one thread per page
+    flow.run(executor=LocalDaskExecutor(scheduler="threads", num_workers=4))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file